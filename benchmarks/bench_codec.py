@@ -0,0 +1,117 @@
+# Per-poll CPU cost of building the request, decoding the response and converting values for Domoticz
+# Usage: python3 benchmarks/bench_codec.py [polls]
+import json
+import os
+import sys
+import textwrap
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from harness import domoticz_stub  # noqa: E402
+domoticz_stub.install()
+
+import plugin  # noqa: E402
+from venta import VentaAPI, FrameDecoder  # noqa: E402
+
+RESPONSE_DOCUMENT = {
+    "Header": {"DeviceType": 2, "MacAdress": "ff:ff:ff:ff:ff:ff", "Error": 0},
+    "Action": {"Power": True, "SleepMode": False, "Automatic": False, "FanSpeed": 2, "TargetHum": 50,
+               "Timer": 0, "SysLanguage": 0, "ChildLock": False, "Boost": False, "TempUnit": 0,
+               "DisplayLeft": 0, "DisplayRight": 1},
+    "Info": {"OperationT": 12345, "FilterT": 2345, "ServiceT": 345, "Warnings": 0},
+    "Measure": {"Temperature": 21.5, "Humidity": 45, "Dust": 3, "FanRpm": 850, "WaterLevel": 2},
+}
+RESPONSE_BODY = json.dumps(RESPONSE_DOCUMENT)
+RESPONSE = f"HTTP/1.1 200 OK\nContent-Length: {len(RESPONSE_BODY)}\n\n{RESPONSE_BODY}\0".encode()
+
+
+# Implementation before precompiled templates and lookup tables
+def legacy_prep_method(api, method):
+    command_line = api.header
+    prepared_command = f"""{VentaAPI.METHODS[method]}
+                        Content-Length: {len(command_line)}
+                        
+                        {{{command_line}}}"""
+    return textwrap.dedent(prepared_command).encode()
+
+
+def legacy_bool_to_number(data, mapping=None):
+    if mapping is None:
+        mapping = [False, True]
+    return {'n_value': mapping.index(data)}
+
+
+def legacy_selector_switch_level_mapping(data, mapping):
+    level = mapping.index(data) * 10
+    return {'n_value': int(level), 's_value': str(level)}
+
+
+def legacy_to_alert(data, mapping):
+    return {'n_value': int(mapping[data][0]), 's_value': str(mapping[data][1])}
+
+
+WATER_LEVELS = [(0, 'Power off/No container'), (3, 'Low'), (4, 'Empty'), (2, 'Medium'), (1, 'Full')]
+LEGACY_CODECS = [
+    ('Measure', 'Temperature', plugin.to_float, ()),
+    ('Measure', 'Humidity', plugin.humidity, ()),
+    ('Measure', 'Dust', plugin.to_float, ()),
+    ('Measure', 'FanRpm', plugin.to_float, ()),
+    ('Measure', 'WaterLevel', legacy_to_alert, (WATER_LEVELS,)),
+    ('Action', 'Automatic', legacy_bool_to_number, ()),
+    ('Action', 'ChildLock', legacy_bool_to_number, ()),
+    ('Action', 'Power', legacy_bool_to_number, ()),
+    ('Action', 'SleepMode', legacy_bool_to_number, ()),
+    ('Action', 'DisplayLeft', plugin.to_number, ()),
+    ('Action', 'DisplayRight', plugin.to_number, ()),
+    ('Action', 'TempUnit', plugin.to_number, ()),
+    ('Action', 'FanSpeed', legacy_selector_switch_level_mapping, (VentaAPI.FAN_SPED,)),
+    ('Action', 'TargetHum', legacy_selector_switch_level_mapping, (VentaAPI.TARGET_HUM,)),
+    ('Action', 'Timer', legacy_selector_switch_level_mapping, (VentaAPI.TARGET_TIMERS,)),
+]
+
+
+def legacy_poll(api):
+    legacy_prep_method(api, 'get_info')
+    data = RESPONSE.decode()
+    parsed = json.loads(data[data.rfind('\n') + 1:-1])
+    for category, name, conversion, args in LEGACY_CODECS:
+        conversion(parsed[category][name], *args)
+
+
+def current_poll(api, decoder, units_by_key):
+    api.get_info_str()
+    for parsed in decoder.feed(RESPONSE):
+        for category, fields in parsed.items():
+            units = units_by_key.get(category, {})
+            for key, value in fields.items():
+                unit = units.get(key)
+                if unit is not None:
+                    unit.data_conversion(value, *unit._args)
+
+
+REPEAT = 5
+
+
+def main():
+    polls = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    api = VentaAPI('ff:ff:ff:ff:ff:ff', '127.0.0.1', hash='0', app_name='Venta App')
+    device = plugin.VentaDevice(0, api, scheduler=None)
+    device.prepare_devices_list()
+    units_by_key = device.UNITS_BY_KEY
+    decoder = FrameDecoder()
+
+    # Best of several interleaved runs, single runs vary a lot with the machine load and clock
+    before_runs, after_runs = [], []
+    for _ in range(REPEAT):
+        before_runs.append(timeit.timeit(lambda: legacy_poll(api), number=polls))
+        after_runs.append(timeit.timeit(lambda: current_poll(api, decoder, units_by_key), number=polls))
+    before = min(before_runs) / polls
+    after = min(after_runs) / polls
+    print(f"polls: {polls}, best of {REPEAT}")
+    print(f"before: {before * 1e6:8.2f} us/poll")
+    print(f"after:  {after * 1e6:8.2f} us/poll ({before / after:.2f}x)")
+
+
+if __name__ == '__main__':
+    main()
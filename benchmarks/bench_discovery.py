@@ -0,0 +1,51 @@
+# Discovery of fake Venta devices listening on several loopback addresses
+# Usage: python3 benchmarks/bench_discovery.py [--devices 5] [--subnet 127.0.0.0/24] [--concurrency 64] [--timeout 0.5]
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from harness.fake_venta import FakeVenta  # noqa: E402
+from venta import VentaDiscovery, expand_hosts  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark LAN discovery against fake Venta devices")
+    parser.add_argument('--devices', type=int, default=5)
+    parser.add_argument('--subnet', default='127.0.0.0/24', help="loopback subnet the devices are spread over")
+    parser.add_argument('--port', type=int, default=48000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--timeout', type=float, default=0.5)
+    args = parser.parse_args()
+
+    hosts = expand_hosts(args.subnet)
+    # Spread devices over the subnet, the last one at its end
+    step = max(1, len(hosts) // args.devices)
+    addresses = [hosts[min(len(hosts) - 1, (index + 1) * step - 1)] for index in range(args.devices)]
+    servers = [FakeVenta(host, args.port, mac=f"02:00:00:00:00:{index:02x}").start()
+               for index, host in enumerate(addresses)]
+    try:
+        discovery = VentaDiscovery(hosts, [args.port], args.timeout, args.concurrency)
+        started = time.perf_counter()
+        found = discovery.scan()
+        print(f"full scan of {len(hosts)} hosts: {time.perf_counter() - started:.3f} s, "
+              f"{len(found)}/{args.devices} devices found")
+
+        last_mac = f"02:00:00:00:00:{args.devices - 1:02x}"
+        started = time.perf_counter()
+        address = discovery.resolve(last_mac)
+        print(f"resolve of a cached device: {(time.perf_counter() - started) * 1000:.1f} ms -> {address}")
+
+        discovery.cache.clear()
+        started = time.perf_counter()
+        address = discovery.resolve(last_mac)
+        print(f"resolve without cache: {(time.perf_counter() - started) * 1000:.1f} ms -> {address}")
+    finally:
+        for server in servers:
+            server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+# End to end benchmark of plugin.py against the fake Venta device, without Domoticz
+# Usage: python3 benchmarks/bench_plugin.py [--polls 200] [--commands 50] [--latency 0] [--fragment 0] [--pad 0]
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from harness import domoticz_stub as stub  # noqa: E402
+from harness.fake_venta import FakeVenta  # noqa: E402
+
+
+def summary(name, samples, unit='ms', scale=1000.0):
+    samples = sorted(sample * scale for sample in samples)
+    if not samples:
+        print(f"{name:<28} no samples")
+        return
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    print(f"{name:<28} mean {statistics.mean(samples):8.3f} {unit}  p50 {statistics.median(samples):8.3f} {unit}  "
+          f"p95 {p95:8.3f} {unit}  n={len(samples)}")
+
+
+def start_plugin(server, options=''):
+    host, port = server.address
+    plugin = stub.load_plugin({'Address': host, 'Port': str(port), 'Mode2': '25', 'Mode5': options})
+    plugin.onStart()
+    device = plugin._plugin.devices[0]
+    if not stub.run_until(device.conn.Connected, timeout=5):
+        sys.exit("Plugin did not connect to the fake device")
+    stub.run_until(lambda: device.polls > 0, timeout=5)
+    return plugin, device
+
+
+def bench_polls(device, polls):
+    round_trips = []
+    for _ in range(polls):
+        done = device.polls + 1
+        started = time.perf_counter()
+        device.request_info()
+        if not stub.run_until(lambda: device.polls >= done, timeout=5, step=0):
+            print("poll timed out")
+            continue
+        round_trips.append(time.perf_counter() - started)
+    return round_trips
+
+
+def bench_updates_per_poll(server, device, polls):
+    per_poll = {}
+    for changing in (False, True):
+        stub.update_calls.clear()
+        for poll in range(polls):
+            if changing:
+                server.set_measure(Humidity=40 + poll % 20, Dust=poll % 7)
+            done = device.polls + 1
+            device.request_info()
+            stub.run_until(lambda: device.polls >= done, timeout=5, step=0)
+        per_poll['changing' if changing else 'idle'] = stub.total_updates() / polls
+    return per_poll
+
+
+def bench_commands(server, device, commands):
+    unit = device.UNITS['FanSpeed']
+    published, confirmed = [], []
+    for command in range(commands):
+        level = 10 + (command % 5) * 10
+        speed = level // 10
+        started = time.perf_counter()
+        stub.command(unit.id, 'Set Level', level)
+        if stub.Devices[unit.id].nValue == level:
+            published.append(time.perf_counter() - started)
+        if stub.run_until(lambda: server.state['Action']['FanSpeed'] == speed and unit.expected_value is None
+                          and stub.Devices[unit.id].nValue == level, timeout=5, step=0):
+            confirmed.append(time.perf_counter() - started)
+        else:
+            print("command timed out")
+    return published, confirmed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark plugin.py against the fake Venta device")
+    parser.add_argument('--polls', type=int, default=200)
+    parser.add_argument('--commands', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--fragment', type=int, default=0)
+    parser.add_argument('--pad', type=int, default=0)
+    parser.add_argument('--options', default='', help="plugin Options field (Mode5)")
+    args = parser.parse_args()
+
+    server = FakeVenta(latency=args.latency, fragment=args.fragment, pad=args.pad).start()
+    try:
+        plugin, device = start_plugin(server, args.options)
+        print(f"fake device: latency {args.latency} s, fragment {args.fragment} B, pad {args.pad} B")
+        summary("poll round trip", bench_polls(device, args.polls))
+        published, confirmed = bench_commands(server, device, args.commands)
+        summary("command -> Domoticz", published)
+        summary("command -> confirmed state", confirmed)
+        for state, updates in bench_updates_per_poll(server, device, args.polls).items():
+            print(f"{'Devices.Update per poll':<28} {updates:8.2f} ({state} values)")
+        plugin.onStop()
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
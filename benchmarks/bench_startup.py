@@ -0,0 +1,58 @@
+# Plugin startup cost against the Domoticz stub: import, onStart and time to the first answered poll
+# Usage: python3 benchmarks/bench_startup.py [--runs 50] [--devices 1] [--debug 0] [--options '']
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from harness import domoticz_stub as stub  # noqa: E402
+from harness.fake_venta import FakeVenta  # noqa: E402
+
+
+def start(servers, debug, options):
+    parameters = {'Address': ','.join(server.address[0] for server in servers), 'Port': str(servers[0].address[1]),
+                  'Mode2': '25', 'Mode5': options, 'Mode6': str(debug)}
+    started = time.perf_counter()
+    plugin = stub.load_plugin(parameters)
+    imported = time.perf_counter()
+    plugin.onStart()
+    on_start = time.perf_counter()
+    devices = plugin._plugin.devices
+    if not stub.run_until(lambda: all(device.polls > 0 for device in devices), timeout=5, step=0):
+        sys.exit("No response to the first poll")
+    first_poll = time.perf_counter()
+    plugin.onStop()
+    return imported - started, on_start - imported, first_poll - on_start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark plugin.py startup against the Domoticz stub")
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--devices', type=int, default=1)
+    parser.add_argument('--debug', default='0', help="Mode6 debug level, e.g. 0, 62 or -1")
+    parser.add_argument('--options', default='', help="plugin Options field (Mode5)")
+    args = parser.parse_args()
+
+    # All devices share the port, each listens on its own loopback address
+    servers = [FakeVenta(f"127.0.0.{index + 1}").start() for index in range(args.devices)]
+    port = servers[0].address[1]
+    for server in servers[1:]:
+        server.stop()
+    servers[1:] = [FakeVenta(f"127.0.0.{index + 2}", port).start() for index in range(args.devices - 1)]
+    try:
+        results = [start(servers, args.debug, args.options) for _ in range(args.runs)]
+    finally:
+        for server in servers:
+            server.stop()
+    print(f"{args.devices} device(s), debug {args.debug}, {args.runs} runs")
+    for name, samples in zip(("import plugin.py", "onStart", "onStart -> first poll answered"), zip(*results)):
+        samples = sorted(sample * 1000 for sample in samples)
+        print(f"{name:<32} mean {statistics.mean(samples):8.3f} ms  p50 {statistics.median(samples):8.3f} ms  "
+              f"max {samples[-1]:8.3f} ms")
+
+
+if __name__ == '__main__':
+    main()
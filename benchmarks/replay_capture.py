@@ -0,0 +1,49 @@
+# Feeds a capture file recorded with the record option through plugin.py, without Domoticz and devices
+# Usage: python3 benchmarks/replay_capture.py CAPTURE [--speed 0] [--address 192.168.1.10] [--options '']
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from harness import domoticz_stub as stub  # noqa: E402
+from venta import CaptureWriter, read_capture  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a Venta capture file through plugin.py")
+    parser.add_argument('capture')
+    parser.add_argument('--speed', default='0', help="0 - at once, 1 - original pacing, N - N times faster")
+    parser.add_argument('--address', default='127.0.0.1', help="Address field the capture was recorded with")
+    parser.add_argument('--options', default='', help="additional plugin Options field (Mode5)")
+    args = parser.parse_args()
+
+    capture = os.path.abspath(args.capture)
+    received = sum(1 for record in read_capture(capture) if record[1] == CaptureWriter.RECEIVED)
+    options = f"replay={capture};replay_speed={args.speed}" + (f";{args.options}" if args.options else '')
+    plugin = stub.load_plugin({'Address': args.address, 'Mode5': options})
+    # Replay runs in slices from onHeartbeat, count only the time spent in the plugin
+    busy = [0.0]
+    on_heartbeat = plugin.onHeartbeat
+
+    def timed_heartbeat():
+        started = time.perf_counter()
+        on_heartbeat()
+        busy[0] += time.perf_counter() - started
+
+    plugin.onHeartbeat = timed_heartbeat
+    started = time.perf_counter()
+    plugin.onStart()
+    if not stub.run_until(lambda: plugin._plugin.replay is None, timeout=24 * 3600):
+        sys.exit("Replay did not finish")
+    elapsed = time.perf_counter() - started
+    polls = sum(device.polls for device in plugin._plugin.devices)
+    print(f"{received} received records, {polls} documents in {busy[0]:.3f} s of plugin time "
+          f"({polls / busy[0] if busy[0] else 0:.0f} documents/s), {elapsed:.1f} s wall time, "
+          f"{stub.total_updates()} Devices.Update calls")
+    plugin.onStop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+# Minimal stand-in for the Domoticz Python plugin framework, drives plugin.py without Domoticz
+"""
+Connections are real non-blocking TCP sockets, served by a select loop which calls plugin callbacks
+the way Domoticz does: onConnect, onMessage, onDisconnect, onHeartbeat, onCommand.
+
+    plugin = load_plugin({'Address': '127.0.0.1', 'Port': '48000', ...})
+    plugin.onStart()
+    run(seconds=1.0)
+    command(unit=13, command='Set Level', level=30)
+    run_until(lambda: Devices[13].nValue == 30)
+"""
+import errno
+import importlib.util
+import os
+import selectors
+import socket
+import sys
+import time
+import types
+
+PLUGIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'plugin.py')
+
+DEFAULT_PARAMETERS = {
+    'HardwareID': 1, 'HomeFolder': '', 'Key': 'VENTA', 'Name': 'Venta',
+    'Address': '127.0.0.1', 'Port': '48000', 'Mode1': 'ff:ff:ff:ff:ff:ff', 'Mode2': '25', 'Mode3': '0',
+    'Mode4': 'Venta App', 'Mode5': '', 'Mode6': '0',
+}
+
+Devices = {}
+Parameters = {}
+log = []
+# Number of Device.Update calls, per unit
+update_calls = {}
+
+_selector = selectors.DefaultSelector()
+_plugin = None
+_heartbeat = 10
+_next_heartbeat = 0
+_echo_log = False
+
+
+def _log(level, message):
+    log.append((time.monotonic(), level, message))
+    if _echo_log:
+        print(f"{level}: {message}")
+
+
+def Debug(message):
+    _log('Debug', message)
+
+
+def Log(message):
+    _log('Log', message)
+
+
+def Status(message):
+    _log('Status', message)
+
+
+def Error(message):
+    _log('Error', message)
+
+
+def Debugging(level):
+    pass
+
+
+def Heartbeat(seconds):
+    global _heartbeat
+    _heartbeat = max(1, min(int(seconds), 30))
+
+
+class Connection:
+    def __init__(self, Name, Transport='TCP/IP', Protocol='None', Address='', Port='', Baud=0):
+        self.Name = Name
+        self.Transport = Transport
+        self.Protocol = Protocol
+        self.Address = Address
+        self.Port = Port
+        self._socket = None
+        self._connected = False
+
+    def __str__(self):
+        return f"Connection {self.Name} {self.Address}:{self.Port}"
+
+    def Connected(self):
+        return self._connected
+
+    def Connecting(self):
+        return self._socket is not None and not self._connected
+
+    def Connect(self):
+        if self._socket is not None:
+            return
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setblocking(False)
+        result = self._socket.connect_ex((self.Address, int(self.Port)))
+        if result not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self._close()
+            _call('onConnect', self, result, os.strerror(result))
+            return
+        _selector.register(self._socket, selectors.EVENT_WRITE, self)
+
+    def Send(self, Message, Delay=0):
+        if not self._connected:
+            Error(f"{self.Name}: Send on a connection which is not connected")
+            return
+        if isinstance(Message, str):
+            Message = Message.encode()
+        self._socket.setblocking(True)
+        try:
+            self._socket.sendall(Message)
+        except OSError as e:
+            Error(f"{self.Name}: Send failed {e}")
+        finally:
+            self._socket.setblocking(False)
+
+    def Disconnect(self):
+        if self._socket is None:
+            return
+        self._close()
+        _call('onDisconnect', self)
+
+    def _close(self):
+        try:
+            _selector.unregister(self._socket)
+        except (KeyError, ValueError):
+            pass
+        self._socket.close()
+        self._socket = None
+        self._connected = False
+
+    def _on_event(self, mask):
+        if not self._connected:
+            error = self._socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                self._close()
+                _call('onConnect', self, error, os.strerror(error))
+                return
+            self._connected = True
+            _selector.modify(self._socket, selectors.EVENT_READ, self)
+            _call('onConnect', self, 0, 'Success')
+            return
+        try:
+            data = self._socket.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if data:
+            _call('onMessage', self, data)
+        else:
+            self.Disconnect()
+
+
+class Device:
+    def __init__(self, Name='', Unit=0, TypeName='', Type=0, Subtype=0, Switchtype=0, Image=0, Options=None,
+                 Used=0, DeviceID='', Description=''):
+        self.Name = Name
+        self.Unit = Unit
+        self.ID = Unit
+        self.TypeName = TypeName
+        self.Type = Type
+        self.SubType = Subtype
+        self.SwitchType = Switchtype
+        self.Image = Image
+        self.Options = Options or {}
+        self.Used = Used
+        self.DeviceID = DeviceID
+        self.Description = Description
+        self.nValue = 0
+        self.sValue = ''
+        self.LastLevel = 0
+        self.TimedOut = 0
+
+    def __str__(self):
+        return f"Unit {self.Unit} {self.Name}: {self.nValue};{self.sValue}"
+
+    def Create(self):
+        Devices[self.Unit] = self
+
+    def Delete(self):
+        Devices.pop(self.Unit, None)
+
+    def Update(self, nValue, sValue, **kwargs):
+        self.nValue = nValue
+        self.sValue = sValue
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+        update_calls[self.Unit] = update_calls.get(self.Unit, 0) + 1
+
+
+def _call(callback, *args):
+    if _plugin is not None and hasattr(_plugin, callback):
+        getattr(_plugin, callback)(*args)
+
+
+def install():
+    """Makes 'import Domoticz' return this module."""
+    sys.modules['Domoticz'] = sys.modules[__name__]
+
+
+def load_plugin(parameters=None, path=PLUGIN_PATH, echo_log=False):
+    """Imports a fresh copy of plugin.py with Devices and Parameters of the stub."""
+    global _plugin, _echo_log
+    install()
+    reset()
+    _echo_log = echo_log
+    Parameters.update(DEFAULT_PARAMETERS)
+    Parameters.update(parameters or {})
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(path)))
+    spec = importlib.util.spec_from_file_location('plugin', path)
+    module = importlib.util.module_from_spec(spec)
+    module.Devices = Devices
+    module.Parameters = Parameters
+    spec.loader.exec_module(module)
+    _plugin = module
+    return module
+
+
+def reset():
+    global _next_heartbeat
+    for key in list(_selector.get_map() or {}):
+        _selector.get_map()[key].data._close()
+    Devices.clear()
+    Parameters.clear()
+    log.clear()
+    update_calls.clear()
+    _next_heartbeat = 0
+
+
+def command(unit, command, level=0, hue=''):
+    _call('onCommand', unit, command, level, hue)
+
+
+def run(seconds=0.0):
+    """Serves connections and heartbeats for the given time, at least one pass is done."""
+    global _next_heartbeat
+    deadline = time.monotonic() + seconds
+    while True:
+        now = time.monotonic()
+        if _next_heartbeat == 0:
+            _next_heartbeat = now + _heartbeat
+        elif now >= _next_heartbeat:
+            _next_heartbeat = now + _heartbeat
+            _call('onHeartbeat')
+        timeout = max(0.0, min(deadline, _next_heartbeat) - time.monotonic())
+        if _selector.get_map():
+            for key, mask in _selector.select(timeout):
+                key.data._on_event(mask)
+        else:
+            time.sleep(timeout)
+        if time.monotonic() >= deadline:
+            return
+
+
+def run_until(predicate, timeout=10.0, step=0.01):
+    """Runs the loop until predicate() is true, returns False on timeout."""
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() >= deadline:
+            return False
+        run(step)
+    return True
+
+
+def total_updates():
+    return sum(update_calls.values())
@@ -0,0 +1,141 @@
+# Local stand-in for a Venta device, speaks GET /Complete and POST /Action
+"""
+Usage: python3 harness/fake_venta.py [--host 127.0.0.1] [--port 48000] [--latency 0.05] [--fragment 64]
+                                     [--drop 0.1] [--pad 2048] [--mac ff:ff:ff:ff:ff:ff]
+"""
+import argparse
+import copy
+import json
+import os
+import random
+import socketserver
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from venta import FrameDecoder  # noqa: E402
+
+DEFAULT_STATE = {
+    "Header": {"DeviceType": 2, "MacAdress": "ff:ff:ff:ff:ff:ff", "Error": 0},
+    "Action": {"Power": True, "SleepMode": False, "Automatic": False, "FanSpeed": 2, "TargetHum": 50,
+               "Timer": 0, "SysLanguage": 0, "ChildLock": False, "Boost": False, "TempUnit": 0,
+               "DisplayLeft": 0, "DisplayRight": 1, "CleanLanguage": 0},
+    "Info": {"SWDisplay": "1.0", "SWPower": "1.0", "SWWIFI": "1.0", "Warnings": 0,
+             "OperationT": 12345, "DiscIonT": 2345, "CleaningT": 1234, "FilterT": 345, "ServiceT": 4567,
+             "UVCOnT": 0, "UVCOffT": 0},
+    "Measure": {"Temperature": 21.5, "Humidity": 45, "Dust": 3, "FanRpm": 850, "WaterLevel": 2},
+}
+
+
+class FakeVenta(socketserver.ThreadingTCPServer):
+    """Threaded TCP server keeping the state of one purifier.
+
+    latency - seconds to wait before answering
+    fragment - send responses in chunks of that many bytes (0 - at once)
+    drop - probability of closing the connection instead of answering
+    pad - extra bytes added to every response, to test long responses
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, mac='ff:ff:ff:ff:ff:ff', latency=0.0, fragment=0, drop=0.0,
+                 pad=0, seed=None):
+        super().__init__((host, port), FakeVentaHandler)
+        self.state = copy.deepcopy(DEFAULT_STATE)
+        self.state['Header']['MacAdress'] = mac
+        self.latency = latency
+        self.fragment = fragment
+        self.drop = drop
+        self.pad = pad
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = {'GET /Complete': 0, 'POST /Action': 0}
+        self.connections = 0
+        self._thread = None
+
+    @property
+    def address(self):
+        return self.server_address[0], self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def set_measure(self, **values):
+        with self.lock:
+            self.state['Measure'].update(values)
+
+    def handle_request_document(self, method, document):
+        with self.lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+            if method == 'POST /Action':
+                for name, value in document.get('Action', {}).items():
+                    self.state['Action'][name] = value
+                if not self.state['Action']['Power']:
+                    self.state['Measure']['FanRpm'] = 0
+            response = copy.deepcopy(self.state)
+        if self.pad:
+            response['Header']['Padding'] = 'x' * self.pad
+        body = json.dumps(response)
+        return f"HTTP/1.1 200 OK\r\nContent-Length: {len(body)}\r\n\r\n{body}".encode()
+
+
+class FakeVentaHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        decoder = FrameDecoder()
+        while True:
+            try:
+                data = self.request.recv(4096)
+            except OSError:
+                return
+            if not data:
+                return
+            for document in decoder.feed(data):
+                method = 'POST /Action' if 'Action' in document else 'GET /Complete'
+                if server.latency:
+                    time.sleep(server.latency)
+                if server.drop and server.random.random() < server.drop:
+                    return
+                response = server.handle_request_document(method, document)
+                try:
+                    if server.fragment:
+                        for start in range(0, len(response), server.fragment):
+                            self.request.sendall(response[start:start + server.fragment])
+                            time.sleep(0.001)
+                    else:
+                        self.request.sendall(response)
+                except OSError:
+                    return
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Venta device")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=48000)
+    parser.add_argument('--mac', default='ff:ff:ff:ff:ff:ff')
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--fragment', type=int, default=0)
+    parser.add_argument('--drop', type=float, default=0.0)
+    parser.add_argument('--pad', type=int, default=0)
+    args = parser.parse_args()
+
+    server = FakeVenta(args.host, args.port, args.mac, args.latency, args.fragment, args.drop, args.pad)
+    print(f"Fake Venta listening on {server.address[0]}:{server.address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
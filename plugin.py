@@ -4,18 +4,50 @@
 <plugin key="VENTA" name="Venta based on sockets." author="ajarzyn" version="0.0.3">
     <description>
         <h2>Venta based on sockets.</h2><br/>
-        Be aware:
-         Values greater than 30 seconds will cause a message to be regularly logged about the plugin not responding.
-         The plugin will actually function correctly with values greater than 30 though.
+        Several purifiers can be driven by one hardware entry, enter comma separated IP addresses,
+        mac addresses and hashes (last mac/hash is used for the remaining devices).<br/>
+        Data pull interval is adapted to the device state. Device is polled every poll_min seconds after a command
+        or a large change of humidity or dust, the interval is doubled up to poll_max seconds when power is off
+        or values are stable.<br/>
+        Options:
+        <ul style="list-style-type:square">
+            <li>refresh_polls - force devices update every N polls even if values did not change (0 - never)</li>
+            <li>refresh_interval - force devices update at least every N seconds, keep it below the Domoticz sensor timeout (default 1800, 0 - never)</li>
+            <li>poll_min - shortest data pull interval in seconds (default 5)</li>
+            <li>poll_max - longest data pull interval in seconds (default 300)</li>
+            <li>diagnostics - 1 to create Poll RTT/Missed polls/Parse time/Reconnects devices (default 0)</li>
+            <li>breaker_threshold - consecutive failures after which the device is marked as timed out and
+                only probed every backoff_max seconds (default 5)</li>
+            <li>backoff_max - longest delay between reconnection attempts in seconds (default 300)</li>
+            <li>history - 1 to keep history of measurements, publish Dust 1h and Humidity 1h averages and keep it
+                in a snapshot file between restarts (default 0)</li>
+            <li>history_samples - number of recent samples kept for every measure (default 720)</li>
+            <li>hum_control - 1 to let the plugin hold humidity between hum_target +/- hum_band by changing FanSpeed and
+                Boost, or TargetHum in Automatic mode (default 0)</li>
+            <li>hum_target, hum_band - humidity to hold and its allowed deviation in % (default 50, 3)</li>
+            <li>hum_interval - shortest time between two changes made by the controller in seconds (default 300)</li>
+            <li>record - capture file (relative to the Domoticz home folder) to append all sent and received data to</li>
+            <li>replay - capture file to feed through the plugin instead of connecting to the devices</li>
+            <li>replay_speed - 0 replays the capture at once, 1 with original pacing, N times faster (default 1)</li>
+            <li>discover - hosts and subnets (192.168.1.0/24) searched for a device by its MAC address when it stops responding</li>
+            <li>discover_ports, discover_after, discover_timeout, discover_concurrency - discovery settings</li>
+            <li>disable_groups - comma separated unit groups not to create: measures, controls, settings, service, firmware</li>
+            <li>profile_NAME - named profile selected with the Profile device, e.g. profile_night=SleepMode:on,FanSpeed:1,ChildLock:on</li>
+            <li>derived - comma separated derived units: ewma (dust average), aqi (24 h dust mean and air quality), dewpoint, fan (fan RPM check)</li>
+            <li>dust_tau - time constant of the dust average in seconds (default 600)</li>
+            <li>poll_timeout - seconds to wait for the answer to a poll before the READ connection is recycled (default 10)</li>
+            <li>stats_interval - seconds between timing summaries in the debug log and diagnostic devices (default 300)</li>
+        </ul>
     </description>
     <params>
-        <param field="Address" label="Venta IP Address" width="200px" required="true" default="127.0.0.1"/>
-        <param field="Mode1" label="mac Address" width="150px" required="false" default="ff:ff:ff:ff:ff:ff"/>
+        <param field="Address" label="Venta IP Address(es)" width="200px" required="true" default="127.0.0.1"/>
+        <param field="Mode1" label="mac Address(es)" width="150px" required="false" default="ff:ff:ff:ff:ff:ff"/>
         <param field="Port" label="Venta Port" width="30px" required="true" default="48000"/>
-        <param field="Mode3" label="Hash" width="150px" required="true"/>
+        <param field="Mode3" label="Hash(es)" width="150px" required="true"/>
         <param field="Mode4" label="App Name" width="150px" required="false" default="Venta App"/>
 
         <param field="Mode2" label="Data pull interval in seconds" width="150px" default="25"/>
+        <param field="Mode5" label="Options (key=value;...)" width="300px" required="false" default="refresh_polls=20"/>
         <param field="Mode6" label="Debug" width="150px">
             <options>
                 <option label="None" value="0" default="true"/>
@@ -33,153 +65,666 @@
 """
 
 import Domoticz
+import base64
+import collections
+import functools
 import json
-import socket
-import textwrap
-import queue
-
-
-class VentaAPI:
-    METHODS = {
-        'get_info': 'GET /Complete',
-        'set_opt': 'POST /Action'
-    }
-
-    class OnOff:
-        def __init__(self, parent_class, method_name, *_):
-            self.method_name = method_name
-            self.parent_class = parent_class
-
-        def on(self, *_):
-            return self.parent_class.set_param(self.method_name, 'true')
-
-        def off(self, *_):
-            return self.parent_class.set_param(self.method_name, 'false')
-
-    class ZeroOne:
-        def __init__(self, parent_class, method_name, *args):
-            self.method_name = method_name
-            self.parent_class = parent_class
-            if args:
-                self._set_methods_names(*args[0])
-
-        def _set_methods_names(self, first_name, second_name):
-            setattr(self, first_name, self.zero)
-            setattr(self, second_name, self.one)
-            setattr(self, "off", self.zero)
-            setattr(self, "on", self.one)
-
-        def one(self, *_):
-            return self.parent_class.set_param(self.method_name, 1)
-            # return self.parent, 1
-
-        def zero(self, *_):
-            return self.parent_class.set_param(self.method_name, 0)
-            # return self.parent, 0
-
-    class Levels:
-        def __init__(self, parent_class, method_name, *args):
-            self.method_name = method_name
-            self.parent_class = parent_class
-            self._set_methods_names()
-            if args:
-                self.available_levels = args[0]
-
-        def _set_methods_names(self):
-            setattr(self, "off", self.set_level)
-            setattr(self, "on", self.set_level)
-
-        def set_level(self, domoticz_level, *_):
-            list_idx = int(domoticz_level / 10)
-            if list_idx < len(self.available_levels):
-                return self.parent_class.set_param(self.method_name, self.available_levels[list_idx])
-            else:
-                pass
-                return None, None
-
-    TARGET_HUM = [0, 30, 35, 40, 45, 50, 55, 60, 65, 70]
-    TARGET_TIMERS = [0, 1, 3, 5, 7, 9]
-    FAN_SPED = [0, 1, 2, 3, 4, 5]
-
-    command_dict = {
-        'Power': (OnOff, []),
-        'Automatic': (OnOff, []),
-        'Boost': (OnOff, []),
-        'SleepMode': (OnOff, []),
-        'ChildLock': (OnOff, []),
-        'TempUnit': (ZeroOne, ["celsius", "fahrenheit"]),  # 0 - celsius, 1 - fahrenheit
-        'DisplayLeft': (ZeroOne, ["humidity", "temperature"]),  # 0 - humidity, 1 - temperature
-        'DisplayRight': (ZeroOne, ["vlines", "square"]),  # 0 - vertical line, 1 - square
-        'FanSpeed': (Levels, FAN_SPED),
-        'TargetHum': (Levels, TARGET_HUM),
-        'Timer': (Levels, TARGET_TIMERS),
-        'SysLanguage': (Levels, [0, 1, 2, 3, 4, 5, 6, 7, 8]),
-    }
-
-    SysLang = {
-        0: 'English',
-        1: 'Chinese',
-        2: 'English Kuubek XL-T',
-        3: 'Deutsch(selected)/British',
-        4: 'Deutsch(selected)/French',
-        5: 'British(selected)/French',
-        6: 'Chinese(selected)/British',
-        7: 'Russian(Selected)/British',
-        8: ['Polish(Selected)/British', ['CleanLanguage', 0, 6]]
-    }
-
-    def __init__(self, mac_address, host, port=48000, hash=0, app_name=''):
-        self.header = f'"Header":{{"macAdress":"{mac_address}","DeviceType":2,' \
-                      f'"Hash":"{hash}","DeviceName":"{app_name}"}}'
-        self.host = host
-        self.port = int(port)
-
-    def send_command(self, message):
-        local_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+import logging
+import math
+import os
+import random
+import threading
+import time
+import zlib
+from array import array
+
+from venta import VentaAPI, FrameDecoder, CaptureWriter, VentaDiscovery, expand_hosts, read_capture
+
+# Domoticz debug flag of the "Messages" levels, config and devices are dumped to the log only then
+DEBUG_MESSAGES = 64
+
+
+class PollScheduler:
+    """Decides when the device should be polled.
+
+    Polls fast after a command or a large change of measured values, otherwise backs off
+    exponentially from the base interval while the device is off or its values are stable.
+    Works on monotonic time, so intervals longer than the Domoticz heartbeat are fine.
+    """
+    FAST_POLLS = 3
+    HUMIDITY_STEP = 3
+    DUST_STEP = 5
+
+    def __init__(self, interval, min_interval, max_interval):
+        self.min_interval = min(min_interval, interval)
+        self.max_interval = max(max_interval, interval)
+        self.base_interval = interval
+        self.interval = interval
+        self.fast_polls = 0
+        self.next_poll = 0
+        self.last_sample = None
+
+    def due(self, now) -> bool:
+        return now >= self.next_poll
+
+    def polled(self, now):
+        if self.fast_polls > 0:
+            self.fast_polls -= 1
+        self.next_poll = now + (self.min_interval if self.fast_polls > 0 else self.interval)
+
+    def speed_up(self, now):
+        self.fast_polls = self.FAST_POLLS
+        self.interval = self.base_interval
+        self.next_poll = min(self.next_poll, now + self.min_interval)
+
+    def add_sample(self, now, power, humidity, dust):
+        sample = (power, humidity, dust)
+        last_sample, self.last_sample = self.last_sample, sample
+        if last_sample is None:
+            return
 
-        try:
-            local_socket.settimeout(1)
-            local_socket.connect((self.host, self.port))
-        except Exception as e:
-            Domoticz.Debug("1" + str(e))
-        try:
-            local_socket.settimeout(1)
-            local_socket.sendall(message)
-        except Exception as e:
-            Domoticz.Debug("2" + str(e))
-        try:
-            local_socket.settimeout(1)
-            received_data = local_socket.recv(1024).decode("utf-8")
-        except Exception as e:
-            received_data = ''
-            Domoticz.Debug("3" + str(e))
-        local_socket.close()
-        return received_data
+        if power and last_sample[0] and \
+                (abs(humidity - last_sample[1]) >= self.HUMIDITY_STEP or abs(dust - last_sample[2]) >= self.DUST_STEP):
+            self.speed_up(now)
+        elif not power or sample == last_sample:
+            self.interval = min(self.interval * 2, self.max_interval)
+        else:
+            self.interval = self.base_interval
+
+
+class ConnectionHealth:
+    """Tracks consecutive failures of a device and decides when to try connecting again.
+
+    Every failure doubles the delay before the next attempt, with jitter, so several devices do not
+    retry in step. After threshold failures the circuit opens: no requests are sent and the device is
+    probed once per max_delay. First success closes the circuit again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+    BASE_DELAY = 1.0
+
+    def __init__(self, threshold=5, max_delay=300.0):
+        self.threshold = threshold
+        self.max_delay = max_delay
+        self.state = self.CLOSED
+        self.failures = 0
+        self.next_attempt = 0
+
+    def allow(self, now) -> bool:
+        if now < self.next_attempt or self.state == self.HALF_OPEN:
+            return False
+        if self.state == self.OPEN:
+            # Let a single probe through
+            self.state = self.HALF_OPEN
+        return True
+
+    def is_open(self) -> bool:
+        return self.state != self.CLOSED
+
+    def success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.next_attempt = 0
+
+    def failure(self, now):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.state = self.OPEN
+            delay = self.max_delay
+        else:
+            delay = min(self.BASE_DELAY * 2 ** (self.failures - 1), self.max_delay)
+        self.next_attempt = now + delay * random.uniform(0.8, 1.2)
+
+    def retry_now(self):
+        # Address of the device changed, do not wait for the backoff
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+        self.next_attempt = 0
+
+
+class RequestTracker:
+    """Requests sent on a connection and not answered yet, at most limit at a time.
+
+    Every request gets a deadline. The device answers in order, so a response belongs to the oldest request,
+    a response when nothing is outstanding is a late answer of a cancelled request and is dropped. Requests
+    invalidated before they are answered, e.g. sent before a change of the state, are answered but stale.
+    """
+    class Request:
+        __slots__ = ('sent_at', 'deadline', 'stale')
+
+        def __init__(self, sent_at, deadline):
+            self.sent_at = sent_at
+            self.deadline = deadline
+            self.stale = False
 
-    def _prep_method(self, method, command_name='', value=''):
-        method_string = self.METHODS[method]
+    def __init__(self, timeout=10.0, limit=1):
+        self.timeout = timeout
+        self.limit = limit
+        self.pending = []
 
-        command_line = ''
-        if method is 'set_opt':
-            command_line = f'"Action":{{"{command_name}":{value}}},'
+    def can_send(self) -> bool:
+        return len(self.pending) < self.limit
 
-        command_line += self.header
+    def sent(self, now):
+        self.pending.append(self.Request(now, now + self.timeout))
 
-        prepared_command = f"""{method_string}
-                        Content-Length: {len(command_line)}
-                        
-                        {{{command_line}}}"""
-        return textwrap.dedent(prepared_command).encode()
+    def answered(self):
+        """Oldest outstanding request, None when the response does not belong to any."""
+        return self.pending.pop(0) if self.pending else None
 
-    def get_info(self):
-        return self.send_command(self._prep_method('get_info'))
+    def expired(self, now) -> bool:
+        return bool(self.pending) and now >= self.pending[0].deadline
 
-    def get_info_str(self):
-        return self._prep_method('get_info')
+    def invalidate(self):
+        for request in self.pending:
+            request.stale = True
 
-    def set_param(self, command_name, value):
-        # return self.send_command(self._prep_method('set_opt', command_name, value))
-        return self._prep_method('set_opt', command_name, value)
+    def cancel(self) -> int:
+        cancelled = len(self.pending)
+        self.pending.clear()
+        return cancelled
+
+
+class Histogram:
+    """Latency histogram with fixed buckets, cheap enough to be updated on every callback."""
+    BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        milliseconds = seconds * 1000
+        bucket = 0
+        while bucket < len(self.BUCKETS_MS) and milliseconds > self.BUCKETS_MS[bucket]:
+            bucket += 1
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += milliseconds
+        self.max = max(self.max, milliseconds)
+
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, fraction) -> float:
+        # Upper bound of the bucket holding the given fraction of samples
+        if not self.count:
+            return 0.0
+        needed = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= needed:
+                return self.BUCKETS_MS[bucket] if bucket < len(self.BUCKETS_MS) else self.max
+        return self.max
+
+    def __str__(self):
+        return f"n={self.count} mean={self.mean():.1f}ms p50<={self.percentile(0.5):g}ms " \
+               f"p95<={self.percentile(0.95):g}ms max={self.max:.1f}ms"
+
+
+class Metrics:
+    """Latency histograms and event counters, collected between two summaries."""
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.add(seconds)
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def histogram(self, name) -> Histogram:
+        return self.histograms.get(name) or Histogram()
+
+    def summary(self) -> list:
+        lines = [f"{name}: {str(histogram)}" for name, histogram in sorted(self.histograms.items())]
+        lines += [f"{name}: {value}" for name, value in sorted(self.counters.items())]
+        return lines
+
+    def reset(self):
+        self.histograms = {}
+        self.counters = {}
+
+
+class RingBuffer:
+    """Fixed size buffer of the most recent (time, value) samples."""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array('d', bytes(8 * capacity))
+        self.values = array('d', bytes(8 * capacity))
+        self.head = 0
+        self.size = 0
+
+    def append(self, timestamp, value):
+        self.times[self.head] = timestamp
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def samples(self) -> list:
+        # Oldest first
+        start = (self.head - self.size) % self.capacity
+        return [(self.times[(start + idx) % self.capacity], self.values[(start + idx) % self.capacity])
+                for idx in range(self.size)]
+
+
+class WindowAggregate:
+    """Min/max/mean over a sliding time window.
+
+    Window is split into buckets, a sample only updates its bucket and buckets older than the window
+    are ignored and reused, so memory is fixed and a query costs one pass over the buckets.
+    """
+    def __init__(self, window, buckets):
+        self.window = window
+        self.bucket_length = window / buckets
+        self.epochs = array('q', [-1] * buckets)
+        self.counts = array('d', bytes(8 * buckets))
+        self.sums = array('d', bytes(8 * buckets))
+        self.mins = array('d', bytes(8 * buckets))
+        self.maxs = array('d', bytes(8 * buckets))
+
+    def add(self, timestamp, value):
+        epoch = int(timestamp // self.bucket_length)
+        bucket = epoch % len(self.epochs)
+        if self.epochs[bucket] != epoch:
+            self.epochs[bucket] = epoch
+            self.counts[bucket] = 0
+            self.sums[bucket] = 0
+            self.mins[bucket] = value
+            self.maxs[bucket] = value
+        self.counts[bucket] += 1
+        self.sums[bucket] += value
+        self.mins[bucket] = min(self.mins[bucket], value)
+        self.maxs[bucket] = max(self.maxs[bucket], value)
+
+    def stats(self, now):
+        # Returns (min, max, mean, count) of samples in the window, None if there are none
+        oldest_epoch = int(now // self.bucket_length) - len(self.epochs) + 1
+        count, total, minimum, maximum = 0, 0.0, None, None
+        for bucket, epoch in enumerate(self.epochs):
+            if epoch < oldest_epoch or self.counts[bucket] == 0:
+                continue
+            count += self.counts[bucket]
+            total += self.sums[bucket]
+            minimum = self.mins[bucket] if minimum is None else min(minimum, self.mins[bucket])
+            maximum = self.maxs[bucket] if maximum is None else max(maximum, self.maxs[bucket])
+        if not count:
+            return None
+        return minimum, maximum, total / count, int(count)
+
+    def arrays(self) -> dict:
+        return {'epochs': self.epochs, 'counts': self.counts, 'sums': self.sums, 'mins': self.mins, 'maxs': self.maxs}
+
+
+class MeasureHistory:
+    """Recent samples and 1 min/1 h/24 h aggregates of every measure, with an on-disk snapshot."""
+    MEASURES = ('Temperature', 'Humidity', 'Dust', 'FanRpm', 'WaterLevel')
+    # Window name: (length in seconds, number of buckets)
+    WINDOWS = {'1m': (60, 12), '1h': (3600, 60), '24h': (86400, 96)}
+    SNAPSHOT_VERSION = 1
+
+    def __init__(self, capacity=720):
+        self.samples = {measure: RingBuffer(capacity) for measure in self.MEASURES}
+        self.aggregates = {measure: {window: WindowAggregate(*params) for window, params in self.WINDOWS.items()}
+                           for measure in self.MEASURES}
+
+    def add(self, timestamp, measures: dict):
+        for measure, value in measures.items():
+            if measure in self.samples:
+                self.samples[measure].append(timestamp, value)
+                for aggregate in self.aggregates[measure].values():
+                    aggregate.add(timestamp, value)
+
+    def stats(self, measure, window, now=None):
+        return self.aggregates[measure][window].stats(time.time() if now is None else now)
+
+    def summary(self, window, now=None) -> list:
+        lines = []
+        for measure in self.MEASURES:
+            stats = self.stats(measure, window, now)
+            if stats is not None:
+                lines.append(f"{measure} {window}: min={stats[0]:g} max={stats[1]:g} mean={stats[2]:.1f} n={stats[3]}")
+        return lines
+
+    def _arrays(self):
+        for measure in self.MEASURES:
+            ring = self.samples[measure]
+            yield f"{measure}.times", ring.times
+            yield f"{measure}.values", ring.values
+            for window, aggregate in self.aggregates[measure].items():
+                for name, values in aggregate.arrays().items():
+                    yield f"{measure}.{window}.{name}", values
+
+    def save(self, path):
+        snapshot = {
+            'version': self.SNAPSHOT_VERSION,
+            'rings': {measure: [ring.capacity, ring.head, ring.size] for measure, ring in self.samples.items()},
+            'arrays': {name: base64.b64encode(values.tobytes()).decode() for name, values in self._arrays()},
+        }
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'wb') as snapshot_file:
+            snapshot_file.write(zlib.compress(json.dumps(snapshot).encode()))
+        os.replace(temporary_path, path)
+
+    def load(self, path):
+        with open(path, 'rb') as snapshot_file:
+            snapshot = json.loads(zlib.decompress(snapshot_file.read()))
+        if snapshot.get('version') != self.SNAPSHOT_VERSION:
+            raise ValueError(f"unsupported snapshot version {snapshot.get('version')}")
+        for measure, (capacity, head, size) in snapshot['rings'].items():
+            if measure in self.samples and capacity != self.samples[measure].capacity:
+                # Samples do not fit, aggregates are still restored
+                snapshot['arrays'].pop(f"{measure}.times", None)
+                snapshot['arrays'].pop(f"{measure}.values", None)
+            elif measure in self.samples:
+                self.samples[measure].head = head
+                self.samples[measure].size = size
+        for name, values in self._arrays():
+            if name in snapshot['arrays']:
+                loaded = array(values.typecode, base64.b64decode(snapshot['arrays'][name]))
+                if len(loaded) == len(values):
+                    values[:] = loaded
+
+
+class HumidityController:
+    """Holds humidity within target +/- band.
+
+    In Automatic mode the device regulates itself, so only TargetHum is kept at the target. Otherwise
+    FanSpeed is changed by one step (and Boost as the last step) when humidity leaves the band, at most
+    once per min_interval seconds, so the device has time to react before the next change.
+    """
+    def __init__(self, target=50, band=3, min_interval=300, fan_levels=VentaAPI.FAN_SPED[1:]):
+        self.target = target
+        self.band = band
+        self.min_interval = min_interval
+        self.fan_levels = list(fan_levels)
+        self.last_change = None
+        # Lowest TargetHum level which is not below the target
+        self.target_level = next((level for level in VentaAPI.TARGET_HUM if level >= target), VentaAPI.TARGET_HUM[-1])
+
+    def update(self, now, state: dict, humidity) -> dict:
+        if not state.get('Power', False) or state.get('SleepMode', False):
+            return {}
+        if self.last_change is not None and now - self.last_change < self.min_interval:
+            return {}
+
+        actions = {}
+        if state.get('Automatic', False):
+            if state.get('TargetHum') != self.target_level:
+                actions['TargetHum'] = self.target_level
+        elif humidity < self.target - self.band:
+            fan_speed = state.get('FanSpeed', self.fan_levels[0])
+            if fan_speed < self.fan_levels[-1]:
+                actions['FanSpeed'] = min(level for level in self.fan_levels if level > fan_speed)
+            elif not state.get('Boost', False):
+                actions['Boost'] = True
+        elif humidity > self.target + self.band:
+            fan_speed = state.get('FanSpeed', self.fan_levels[0])
+            if state.get('Boost', False):
+                actions['Boost'] = False
+            elif fan_speed > self.fan_levels[0]:
+                actions['FanSpeed'] = max(level for level in self.fan_levels if level < fan_speed)
+
+        if actions:
+            self.last_change = now
+        return actions
+
+
+class RollingMean:
+    """Time weighted mean over a sliding window, O(1) per sample.
+
+    Every value counts for the time until the next sample, at most max_gap, so fast polls after a change do
+    not outweigh the rest. Window is split into buckets and running totals of the whole window are kept,
+    buckets leaving the window are subtracted from them. Window covers between window - bucket and window.
+    """
+    def __init__(self, window=86400, buckets=24, max_gap=900):
+        self.bucket_length = window / buckets
+        self.sums = array('d', bytes(8 * buckets))
+        self.weights = array('d', bytes(8 * buckets))
+        self.total = 0.0
+        self.weight = 0.0
+        self.max_gap = max_gap
+        self.epoch = None
+        self.last = None
+
+    def _advance(self, epoch):
+        if self.epoch is None or epoch - self.epoch >= len(self.sums):
+            for bucket in range(len(self.sums)):
+                self.sums[bucket] = self.weights[bucket] = 0.0
+            self.total = self.weight = 0.0
+        else:
+            for expired in range(self.epoch + 1, epoch + 1):
+                bucket = expired % len(self.sums)
+                self.total -= self.sums[bucket]
+                self.weight -= self.weights[bucket]
+                self.sums[bucket] = self.weights[bucket] = 0.0
+        self.epoch = epoch
+
+    def add(self, timestamp, value):
+        if self.last is not None:
+            last_timestamp, last_value = self.last
+            weight = min(max(timestamp - last_timestamp, 0.0), self.max_gap)
+            epoch = int(timestamp // self.bucket_length)
+            if self.epoch is None or epoch > self.epoch:
+                self._advance(epoch)
+            bucket = self.epoch % len(self.sums)
+            self.sums[bucket] += last_value * weight
+            self.weights[bucket] += weight
+            self.total += last_value * weight
+            self.weight += weight
+        self.last = (timestamp, value)
+
+    def mean(self):
+        # Running totals may drift a little below zero once everything left the window
+        return self.total / self.weight if self.weight > 1e-6 else None
+
+
+# PM2.5 24 h concentration (µg/m³) breakpoints: low, high, AQI low, AQI high, Domoticz alert level, name
+PM25_BREAKPOINTS = (
+    (0.0, 9.0, 0, 50, 1, 'Good'),
+    (9.1, 35.4, 51, 100, 2, 'Moderate'),
+    (35.5, 55.4, 101, 150, 3, 'Unhealthy for sensitive groups'),
+    (55.5, 125.4, 151, 200, 3, 'Unhealthy'),
+    (125.5, 225.4, 201, 300, 4, 'Very unhealthy'),
+    (225.5, 325.4, 301, 500, 4, 'Hazardous'),
+)
+
+
+def pm25_aqi(concentration: float) -> tuple:
+    """Returns (AQI, alert level, band name) of the 24 h mean PM2.5 concentration."""
+    concentration = math.floor(concentration * 10) / 10
+    for low, high, aqi_low, aqi_high, level, name in PM25_BREAKPOINTS:
+        if concentration <= high:
+            return round((aqi_high - aqi_low) / (high - low) * (max(concentration, low) - low) + aqi_low), level, name
+    return 500, 4, 'Hazardous'
+
+
+def dew_point(temperature: float, humidity: float) -> float:
+    # Magnus formula, good to ±0.35 °C between -45 and 60 °C
+    gamma = math.log(humidity / 100) + 17.62 * temperature / (243.12 + temperature)
+    return 243.12 * gamma / (17.62 - gamma)
+
+
+class DerivedMetrics:
+    """Values derived from measures, every one updated incrementally with each sample.
+
+    ewma - exponentially weighted dust average, time based, so it does not depend on the poll interval
+    aqi - 24 h time weighted dust mean and its PM2.5 air quality band
+    dewpoint - dew point from Temperature and Humidity
+    fan - fan RPM learned per fan state (speed, boost, sleep mode), RPM far from it is reported
+    """
+    METRICS = ('ewma', 'aqi', 'dewpoint', 'fan')
+    # Fan RPM model: samples to learn a state, EWMA weight, allowed deviation in standard deviations
+    # and as a part of the mean, whichever is larger
+    FAN_WARMUP = 5
+    FAN_ALPHA = 0.1
+    FAN_SIGMAS = 4
+    FAN_TOLERANCE = 0.15
+
+    def __init__(self, metrics=METRICS, dust_tau=600):
+        self.metrics = frozenset(metrics)
+        self.dust_tau = dust_tau
+        self.dust_ewma = None
+        self.dust_time = 0
+        self.dust_mean = RollingMean()
+        self.fan_state = None
+        # Fan state to (samples, mean, variance) of its RPM
+        self.fan_stats = {}
+
+    def update(self, now, measures: dict, state: dict) -> dict:
+        """Adds a sample of a powered on device, returns values of derived units."""
+        values = {}
+        dust = measures.get('Dust')
+        if dust is not None and 'ewma' in self.metrics:
+            if self.dust_ewma is None:
+                self.dust_ewma = float(dust)
+            else:
+                self.dust_ewma += (1 - math.exp(-max(now - self.dust_time, 0) / self.dust_tau)) * (dust - self.dust_ewma)
+            self.dust_time = now
+            values['Dust EWMA'] = round(self.dust_ewma, 1)
+        if dust is not None and 'aqi' in self.metrics:
+            self.dust_mean.add(now, dust)
+            mean = self.dust_mean.mean()
+            if mean is not None:
+                aqi, level, name = pm25_aqi(mean)
+                values['Dust 24h'] = round(mean, 1)
+                values['Air quality'] = (level, f"AQI {aqi} {name}")
+        temperature, humidity = measures.get('Temperature'), measures.get('Humidity')
+        # Logarithm of the relative humidity, a broken sensor may report 0 or less
+        if 'dewpoint' in self.metrics and temperature is not None and humidity is not None and 0 < humidity <= 100:
+            values['Dew point'] = round(dew_point(temperature, humidity), 1)
+        if 'fan' in self.metrics and 'FanRpm' in measures:
+            fan = self.check_fan(state, measures['FanRpm'])
+            if fan is not None:
+                values['Fan RPM check'] = fan
+        return values
+
+    def check_fan(self, state, rpm):
+        fan_state = (state.get('FanSpeed'), bool(state.get('Boost')), bool(state.get('SleepMode')))
+        changed, self.fan_state = fan_state != self.fan_state, fan_state
+        if changed:
+            # Fan is still changing its speed
+            return None
+        if fan_state[0] and not rpm:
+            return 4, 'Fan stopped'
+        count, mean, variance = self.fan_stats.get(fan_state, (0, float(rpm), 0.0))
+        deviation = rpm - mean
+        if count >= self.FAN_WARMUP and \
+                abs(deviation) > max(self.FAN_SIGMAS * math.sqrt(variance), self.FAN_TOLERANCE * mean):
+            # Anomalies are not learned, a failing fan would become the norm
+            return 3, f"{rpm:.0f} RPM, expected {mean:.0f}"
+        alpha = max(1 / (count + 1), self.FAN_ALPHA)
+        mean += alpha * deviation
+        variance = (1 - alpha) * (variance + alpha * deviation * deviation)
+        self.fan_stats[fan_state] = (count + 1, mean, variance)
+        if count + 1 < self.FAN_WARMUP:
+            return 0, 'Learning'
+        return 1, 'Normal'
+
+
+class CaptureReplay:
+    """Feeds received data of a capture file to the devices, at once or with the original pacing.
+
+    Records are fed from onHeartbeat, at most SLICE seconds of work per heartbeat, so a long capture
+    does not block Domoticz even when it is replayed at full speed.
+    """
+    SLICE = 0.1
+    # Heartbeat while replaying, in seconds
+    HEARTBEAT = 1
+    def __init__(self, path, speed=1.0):
+        self.records = read_capture(path)
+        self.speed = speed
+        self.started = None
+        self.first_timestamp = None
+        self.next_record = None
+        self.finished = False
+
+    def due_records(self, now):
+        if self.started is None:
+            self.started = now
+        while not self.finished:
+            if self.next_record is None:
+                self.next_record = next(self.records, None)
+                if self.next_record is None:
+                    self.finished = True
+                    break
+                if self.first_timestamp is None:
+                    self.first_timestamp = self.next_record[0]
+            if self.speed > 0 and (self.next_record[0] - self.first_timestamp) / self.speed > now - self.started:
+                break
+            record, self.next_record = self.next_record, None
+            yield record
+
+
+def timed(name):
+    # Records duration of a BasePlugin callback in self.metrics
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args):
+            started = time.perf_counter()
+            try:
+                return method(self, *args)
+            finally:
+                self.metrics.observe(name, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def parse_options(options: str) -> dict:
+    parsed = {}
+    for option in options.split(';'):
+        key, sep, value = option.partition('=')
+        if sep:
+            parsed[key.strip()] = value.strip()
+    return parsed
+
+
+def split_list(value: str) -> list:
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+PROFILE_BOOLS = {'on': True, 'off': False, 'true': True, 'false': False, '1': True, '0': False}
+
+
+def parse_profile(profile: str) -> dict:
+    """Action:value list, e.g. 'SleepMode:on,FanSpeed:1', to the Action request values."""
+    actions = {}
+    for item in split_list(profile):
+        name, sep, value = (part.strip() for part in item.partition(':'))
+        if not sep or name not in VentaAPI.command_dict:
+            raise ValueError(f"unknown action '{item}'")
+        handler, args = VentaAPI.command_dict[name]
+        value = value.lower()
+        if handler is VentaAPI.OnOff:
+            if value not in PROFILE_BOOLS:
+                raise ValueError(f"'{item}' must be on or off")
+            actions[name] = PROFILE_BOOLS[value]
+        elif handler is VentaAPI.ZeroOne:
+            # Either 0/1, off/on or the names of the values, like celsius/fahrenheit
+            names = {**dict(zip(('off', 'on'), (0, 1))), **dict(zip(args, (0, 1))), '0': 0, '1': 1}
+            if value not in names:
+                raise ValueError(f"'{item}' must be one of {', '.join(names)}")
+            actions[name] = names[value]
+        else:
+            if not value.isdigit() or int(value) not in args:
+                raise ValueError(f"'{item}' must be one of {', '.join(str(level) for level in args)}")
+            actions[name] = int(value)
+    if not actions:
+        raise ValueError("no actions")
+    return actions
+
+
+def is_number(value) -> bool:
+    # Document fields may be null or of another type, bool is a state and not a measure
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
 
 
 def to_float(data: int, divider: float = 1.0) -> dict:
@@ -197,19 +742,22 @@ def to_selector_switch(data: int, divider: float = 1.0) -> dict:
     return {'n_value': int(converted), 's_value': str(converted)}
 
 
-def bool_to_number(data: int, mapping: list = None) -> dict:
-    if mapping is None:
-        mapping = [False, True]
-    return {'n_value': mapping.index(data)}
+# Conversions below look values up in tables built once, returned dicts are shared and must not be modified
+BOOL_TO_NUMBER = {False: {'n_value': 0}, True: {'n_value': 1}}
+
 
+def bool_to_number(data: bool) -> dict:
+    return BOOL_TO_NUMBER[data]
 
-def selector_switch_level_mapping(data: int, mapping: list) -> dict:
-    level = mapping.index(data) * 10
-    return {'n_value': int(level), 's_value': str(level)}
 
+def selector_switch_level_mapping(mapping: list):
+    levels = {value: {'n_value': idx * 10, 's_value': str(idx * 10)} for idx, value in enumerate(mapping)}
+    return levels.__getitem__
 
-def to_alert(data: int, mapping: list) -> dict:
-    return {'n_value': int(mapping[data][0]), 's_value': str(mapping[data][1])}
+
+def to_alert(mapping: list):
+    alerts = [{'n_value': int(level), 's_value': str(text)} for level, text in mapping]
+    return alerts.__getitem__
 
 
 def humidity(data: int) -> dict:
@@ -225,194 +773,948 @@ def humidity(data: int) -> dict:
     return {'n_value': int(data), 's_value': str(status)}
 
 
-class BasePlugin:
-    def __init__(self):
-        self.dev_list = []
+def to_text(data) -> dict:
+    return {'s_value': str(data)}
+
+
+def to_alert_value(data: tuple) -> dict:
+    level, text = data
+    return {'n_value': int(level), 's_value': str(text)}
+
+
+def sys_lang_name(level: int) -> str:
+    # SysLang entries are names or [name, additional setting]
+    name = VentaAPI.SysLang[level]
+    return name if isinstance(name, str) else name[0]
+
+
+def selector_switch(levels: list, names: list, off_hidden: bool) -> dict:
+    return dict(TypeName="Selector Switch", Image=7, Used=1,
+                Options={"LevelActions": "|" * (len(levels) - 1),
+                         "LevelNames": "|".join(names),
+                         "LevelOffHidden": "true" if off_hidden else "false",
+                         "SelectorStyle": "1"})
+
+
+SWITCH = dict(TypeName="Switch", Image=9, Used=1)
+
+# Conversion of a switch unit, by the VentaAPI handler sending its command
+SWITCH_CONVERSIONS = {VentaAPI.OnOff: bool_to_number, VentaAPI.ZeroOne: to_number}
+
+
+def writable(group: str, command: str, offset: int, level_name=str, off_hidden: bool = False, **dev_params) -> tuple:
+    # Schema entry of a unit controlling a VentaAPI command, levels of selector switches come from command_dict
+    handler, levels = VentaAPI.command_dict[command]
+    if handler is VentaAPI.Levels:
+        return (group, ['Action', command], offset, [selector_switch_level_mapping(levels)],
+                dict(selector_switch(levels, [level_name(level) for level in levels], off_hidden), **dev_params))
+    return group, ['Action', command], offset, [SWITCH_CONVERSIONS[handler]], dict(SWITCH, **dev_params)
+
+
+# Units of a device: group, /Complete field, unit offset in the device block, data conversion callback with its
+# arguments, Domoticz device parameters. Offsets must never change, Domoticz keeps devices by unit ID.
+# Units are created when their field first appears, groups can be disabled with the disable_groups option.
+UNIT_SCHEMA = [
+    ('measures', ['Measure', 'Temperature'], 0, [to_float], dict(TypeName="Temperature", Used=1)),
+    ('measures', ['Measure', 'Humidity'],    1, [humidity], dict(TypeName="Humidity", Used=1)),
+    ('measures', ['Measure', 'Dust'],        2, [to_float], dict(TypeName="Custom", Used=1,
+                                                                 Options={"Custom": "1;µg/m³"})),
+    ('measures', ['Measure', 'FanRpm'],      3, [to_float], dict(TypeName="Custom", Used=1,
+                                                                 Options={"Custom": "1;RPM"})),
+    ('measures', ['Measure', 'WaterLevel'],  4, [to_alert([(0, 'Power off/No container'),
+                                                           (3, 'Low'),
+                                                           (4, 'Empty'),
+                                                           (2, 'Medium'),
+                                                           (1, 'Full')])], dict(TypeName="Alert", Used=1)),
+
+    # Writable
+    writable('controls', 'Automatic',    5),
+    writable('controls', 'ChildLock',    6),
+    writable('controls', 'Power',        7),
+    writable('controls', 'SleepMode',    8),
+    writable('settings', 'DisplayLeft',  9),
+    writable('settings', 'DisplayRight', 10),
+    writable('settings', 'TempUnit',     11),
+    writable('controls', 'FanSpeed',     12, off_hidden=True),
+    writable('controls', 'TargetHum',    13, lambda level: f"{level}%"),
+    writable('controls', 'Timer',        14, lambda level: f"{level}h"),
+    writable('controls', 'Boost',        15),
+    writable('settings', 'SysLanguage',  16, sys_lang_name, Name='System language'),
+
+    # Read only
+    ('service', ['Info', 'Warnings'],   17, [to_float], dict(TypeName="Custom", Used=1, Options={"Custom": "1;"})),
+    ('service', ['Info', 'OperationT'], 18, [to_float], dict(TypeName="Custom", Used=1, Options={"Custom": "1;h"},
+                                                             Name='Operation time')),
+    ('service', ['Info', 'DiscIonT'],   19, [to_float], dict(TypeName="Custom", Used=1, Options={"Custom": "1;h"},
+                                                             Name='Disc ionizer time')),
+    ('service', ['Info', 'CleaningT'],  20, [to_float], dict(TypeName="Custom", Used=1, Options={"Custom": "1;h"},
+                                                             Name='Cleaning time')),
+    ('service', ['Info', 'FilterT'],    21, [to_float], dict(TypeName="Custom", Used=1, Options={"Custom": "1;h"},
+                                                             Name='Filter time')),
+    ('service', ['Info', 'ServiceT'],   22, [to_float], dict(TypeName="Custom", Used=1, Options={"Custom": "1;h"},
+                                                             Name='Service time')),
+    ('service', ['Info', 'UVCOnT'],     23, [to_float], dict(TypeName="Custom", Used=1, Options={"Custom": "1;h"},
+                                                             Name='UV-C on time')),
+    ('service', ['Info', 'UVCOffT'],    24, [to_float], dict(TypeName="Custom", Used=1, Options={"Custom": "1;h"},
+                                                             Name='UV-C off time')),
+    ('firmware', ['Info', 'SWDisplay'], 25, [to_text], dict(TypeName="Text", Used=0, Name='Display firmware')),
+    ('firmware', ['Info', 'SWPower'],   26, [to_text], dict(TypeName="Text", Used=0, Name='Power firmware')),
+    ('firmware', ['Info', 'SWWIFI'],    27, [to_text], dict(TypeName="Text", Used=0, Name='WiFi firmware')),
+]
+
+
+class Unit:
+    __slots__ = ('id', 'category', 'name', 'data_conversion', '_args', 'dev_params',
+                 'last_update', 'expected_value', 'expected_deadline')
+
+    def __init__(self, id, json_address, data_conversion, dev_params):
+        self.id = id
+        self.category = json_address[0]
+        self.name = json_address[1]
+        self.data_conversion, *self._args = data_conversion
+        self.dev_params = dev_params
+        # Last values passed to Domoticz, used to skip updates which would change nothing
+        self.last_update = None
+        # Value set by a command, until confirmed by the device or deadline passes
+        self.expected_value = None
+        self.expected_deadline = 0
+
+    def set_expected(self, value, deadline):
+        # Publish commanded value at once, without waiting for the device
+        self.expected_value = None
+        self.update_domoticz_dev(value)
+        self.expected_value = value
+        self.expected_deadline = deadline
+
+    def update_domoticz_dev(self, value, force=False):
+        if self.expected_value is not None:
+            if value == self.expected_value or time.monotonic() > self.expected_deadline:
+                self.expected_value = None
+            else:
+                # Device has not applied the command yet, keep the published value
+                return False
+        values = self.data_conversion(value, *self._args)
+        if self.last_update is None and self.id not in Devices:
+            # First value of the field, create the Domoticz device for it
+            Domoticz.Device(**self.dev_params).Create()
+        if not force and values == self.last_update and self.id in Devices:
+            return False
+        update_device(unit=self.id, **values)
+        self.last_update = values
+        return True
+
+
+class VentaDevice:
+    """Single purifier: its connections, units and poll state."""
+    # Unit IDs of the device with index N start at N * UNITS_PER_DEVICE + 1
+    UNITS_PER_DEVICE = 50
+    # Offset of diagnostic and history units in the device block
+    PROFILE_OFFSET = 30
+    DERIVED_OFFSET = 32
+    DIAGNOSTICS_OFFSET = 40
+    HISTORY_OFFSET = 44
+    # Seconds to wait for the response to the Action request
+    WRITE_TIMEOUT = 10
+    # Seconds to keep the commanded value while the device still reports the previous one
+    EXPECTED_VALUE_HOLD = 10
+    # Measures still valid while power is off
+    MEASURED_WHEN_OFF = frozenset(('FanRpm',))
+    # Sections of /Complete which are not device state, not reported as unknown
+    IGNORED_CATEGORIES = frozenset(('Header',))
+
+    def __init__(self, index, venta, scheduler, refresh_polls=20, name_prefix='', diagnostics=False, health=None,
+                 history=None, controller=None, capture=None, offline=False, discovery=None, resolve_after=3,
+                 disabled_groups=(), profiles=(), derived=None, poll_timeout=10.0, refresh_interval=1800):
+        self.index = index
+        self.Venta = venta
+        self.scheduler = scheduler
+        self.health = health if health is not None else ConnectionHealth()
+        self.history = history
+        self.controller = controller
+        self.derived = derived
+        self.capture = capture
+        # Replaying a capture, nothing is sent to the device
+        self.offline = offline
+        # Device is looked for in the LAN after every resolve_after consecutive failures, 0 disables it
+        self.discovery = discovery
+        self.resolve_after = resolve_after
+        self.resolver = None
+        self.resolved_address = None
+        self.refresh_polls = refresh_polls
+        # Polls back off up to poll_max, so refresh by time too, devices not updated within the Domoticz
+        # sensor timeout (60 min by default) are shown as timed out
+        self.refresh_interval = refresh_interval
+        self.last_forced = time.monotonic()
+        self.name_prefix = name_prefix
+        self.diagnostics = diagnostics
+        # UNIT_SCHEMA groups without units
+        self.disabled_groups = frozenset(disabled_groups)
+        # (name, actions) of profiles, selector level 10 * N selects profile N, level 0 is any other state
+        self.profiles = list(profiles)
+        self.profile_unit_id = None
+        # Profile to verify on the first read after it was applied
+        self.profile_check = None
+
         self.UNITS = {}
         self.UNITS_ID_KEYS = {}
+        # Category to key to unit, documents are dispatched through it
+        self.UNITS_BY_KEY = {}
+        # (category, key) of fields present in documents but not mapped to any unit
+        self.unknown_keys = set()
+        # (category, key) of fields whose values the unit cannot convert, each is reported once
+        self.bad_values = set()
+        # Last reported power state, measures are skipped while it is off
+        self.power_on = True
 
         self.conn = None
         self.conn_write = None
-        self.host = ''
-        self.port = ''
-        self.commandToSend = queue.Queue()
-
-        self.Venta = None
+        self.decoders = {}
+        # Actions waiting for the WRITE connection, only the latest value of every action is kept
+        self.pending_actions = {}
+        # Actions of the Action request waiting for its response, queued again when it is lost
+        self.sent_actions = {}
+        self.write_sent_at = None
+        # (unit ID, Domoticz command) to the VentaAPI method handling it
+        self.command_handlers = {}
+
+        self.polls = 0
+        self.updates_written = 0
+        self.updates_skipped = 0
+        self.metrics = Metrics()
+        # Polls sent on the READ connection, only one may be outstanding
+        self.polls_in_flight = RequestTracker(poll_timeout)
 
     def prepare_devices_list(self):
-        self.dev_list = [
-            # Name, socket command, idx, data modification callback, Domoticz devices options, is writable
-            [['Measure', 'Temperature'], [to_float], dict(TypeName="Temperature", Used=1)],
-            [['Measure', 'Humidity'],   [humidity], dict(TypeName="Humidity", Used=1)],
-            [['Measure', 'Dust'],       [to_float], dict(TypeName="Custom", Used=1, Options={"Custom": "1;µg/m³"})],
-            [['Measure', 'FanRpm'],     [to_float], dict(TypeName="Custom", Used=1, Options={"Custom": "1;RPM"})],
-            [['Measure', 'WaterLevel'], [to_alert, [(0, 'Power off/No container'),
-                                                    (3, 'Low'),
-                                                    (4, 'Empty'),
-                                                    (2, 'Medium'),
-                                                    (1, 'Full')]], dict(TypeName="Alert", Used=1)],
-
-            # Writable
-            [['Action', 'Automatic'],   [bool_to_number], dict(TypeName="Switch", Image=9, Used=1)],
-            [['Action', 'ChildLock'],   [bool_to_number], dict(TypeName="Switch", Image=9, Used=1)],
-            [['Action', 'Power'],       [bool_to_number], dict(TypeName="Switch", Image=9, Used=1)],
-            [['Action', 'SleepMode'],   [bool_to_number], dict(TypeName="Switch", Image=9, Used=1)],
-            [['Action', 'DisplayLeft'], [to_number], dict(TypeName="Switch", Image=9, Used=1)],
-            [['Action', 'DisplayRight'], [to_number], dict(TypeName="Switch", Image=9, Used=1)],
-
-            [['Action', 'TempUnit'],    [to_number], dict(TypeName="Switch", Image=9, Used=1)],
-
-            [['Action', 'FanSpeed'],    [selector_switch_level_mapping, VentaAPI.FAN_SPED],
-             dict(TypeName="Selector Switch", Image=7, Used=1,
-                  Options={"LevelActions": "|"*(len(VentaAPI.FAN_SPED)-1),
-                           "LevelNames": "|".join(str(x) for x in VentaAPI.FAN_SPED),
-                           "LevelOffHidden": "true",
-                           "SelectorStyle": "1"})],
-            [['Action', 'TargetHum'],   [selector_switch_level_mapping, VentaAPI.TARGET_HUM],
-             dict(TypeName="Selector Switch", Image=7, Used=1,
-                  Options={"LevelActions": "|"*(len(VentaAPI.TARGET_HUM)-1),
-                           "LevelNames": "%|".join(str(x) for x in VentaAPI.TARGET_HUM)+"%",
-                           "LevelOffHidden": "false",
-                           "SelectorStyle": "1"})],
-            [['Action', 'Timer'],       [selector_switch_level_mapping, VentaAPI.TARGET_TIMERS],
-             dict(TypeName="Selector Switch", Image=7, Used=1,
-                  Options={"LevelActions": "|"*(len(VentaAPI.TARGET_TIMERS)-1),
-                           "LevelNames": "h|".join(str(x) for x in VentaAPI.TARGET_TIMERS)+"h",
-                           "LevelOffHidden": "false",
-                           "SelectorStyle": "1"})],
-        ]
-
-        class Unit:
-            def __init__(self, id, json_address, data_conversion, dev_params):
-                self.id = id
-                self.category = json_address[0]
-                self.name = json_address[1]
-                self.data_conversion, *self._args = data_conversion
-                self.dev_params = dev_params
-
-            def update_domoticz_dev(self, data):
-                update_device(unit=self.id,
-                              **self.data_conversion(data[self.category][self.name], *self._args))
-
-        for dev_idx in range(len(self.dev_list)):
-            tmp_unit = Unit(dev_idx+1, *self.dev_list[dev_idx])
-            tmp_unit.dev_params.update(dict(Name=tmp_unit.name, Unit=tmp_unit.id))
-
-            self.UNITS[tmp_unit.name] = tmp_unit
-            self.UNITS_ID_KEYS[tmp_unit.id] = tmp_unit
+        first_unit_id = self.index * self.UNITS_PER_DEVICE + 1
+        for group, json_address, offset, data_conversion, dev_params in UNIT_SCHEMA:
+            if group in self.disabled_groups:
+                # Known field, not reported as unknown
+                self.UNITS_BY_KEY.setdefault(json_address[0], {})[json_address[1]] = None
+                continue
+            self.add_unit(first_unit_id + offset, json_address, data_conversion, dev_params)
+
+        if self.diagnostics:
+            self.add_units([
+                [['Diagnostics', 'Poll RTT'],     [to_float], dict(TypeName="Custom", Used=1, Options={"Custom": "1;ms"})],
+                [['Diagnostics', 'Missed polls'], [to_float], dict(TypeName="Custom", Used=1, Options={"Custom": "1;"})],
+                [['Diagnostics', 'Parse time'],   [to_float], dict(TypeName="Custom", Used=1, Options={"Custom": "1;ms"})],
+                [['Diagnostics', 'Reconnects'],   [to_float], dict(TypeName="Custom", Used=1, Options={"Custom": "1;"})],
+            ], first_unit_id + self.DIAGNOSTICS_OFFSET)
+
+        if self.profiles:
+            levels = list(range(len(self.profiles) + 1))
+            self.profile_unit_id = first_unit_id + self.PROFILE_OFFSET
+            self.add_unit(self.profile_unit_id, ['Profile', 'Profile'], [selector_switch_level_mapping(levels)],
+                          selector_switch(levels, ['Custom'] + [name for name, _ in self.profiles], False))
+
+        if self.derived is not None:
+            derived_units = [
+                ('ewma', ['Derived', 'Dust EWMA'], [to_float], dict(TypeName="Custom", Used=1,
+                                                                    Options={"Custom": "1;µg/m³"})),
+                ('aqi', ['Derived', 'Dust 24h'], [to_float], dict(TypeName="Custom", Used=1,
+                                                                  Options={"Custom": "1;µg/m³"})),
+                ('aqi', ['Derived', 'Air quality'], [to_alert_value], dict(TypeName="Alert", Used=1)),
+                ('dewpoint', ['Derived', 'Dew point'], [to_float], dict(TypeName="Temperature", Used=1)),
+                ('fan', ['Derived', 'Fan RPM check'], [to_alert_value], dict(TypeName="Alert", Used=1)),
+            ]
+            # Offsets are fixed, enabling a metric does not move units of the others
+            for offset, (metric, *unit) in enumerate(derived_units):
+                if metric in self.derived.metrics:
+                    self.add_unit(first_unit_id + self.DERIVED_OFFSET + offset, *unit)
+
+        if self.history is not None:
+            self.add_units([
+                [['History', 'Dust 1h'],     [to_float], dict(TypeName="Custom", Used=1, Options={"Custom": "1;µg/m³"})],
+                [['History', 'Humidity 1h'], [to_float], dict(TypeName="Custom", Used=1, Options={"Custom": "1;%"})],
+            ], first_unit_id + self.HISTORY_OFFSET)
+
+    def add_units(self, dev_list, first_unit_id):
+        for dev_idx in range(len(dev_list)):
+            self.add_unit(first_unit_id + dev_idx, *dev_list[dev_idx])
+
+    def add_unit(self, unit_id, json_address, data_conversion, dev_params):
+        # Schema parameters are shared by all devices, each unit gets its own copy
+        dev_params = dict(dev_params, Name=self.name_prefix + dev_params.get('Name', json_address[1]), Unit=unit_id)
+        tmp_unit = Unit(unit_id, json_address, data_conversion, dev_params)
+
+        self.UNITS[tmp_unit.name] = tmp_unit
+        self.UNITS_ID_KEYS[tmp_unit.id] = tmp_unit
+        self.UNITS_BY_KEY.setdefault(tmp_unit.category, {})[tmp_unit.name] = tmp_unit
+
+    def publish(self, category, values: dict):
+        # Updates units of values computed by the plugin
+        for name, value in values.items():
+            self.UNITS[name].update_domoticz_dev(value)
+
+    def publish_metrics(self):
+        Domoticz.Debug(f"{self.Venta.host} statistics:")
+        for line in self.metrics.summary():
+            Domoticz.Debug(f"    {line}")
+        if self.diagnostics:
+            self.publish('Diagnostics', {
+                'Poll RTT': round(self.metrics.histogram('poll_rtt').mean(), 1),
+                'Missed polls': self.metrics.counters.get('missed_polls', 0),
+                'Parse time': round(self.metrics.histogram('parse').mean(), 2),
+                'Reconnects': self.metrics.counters.get('reconnects', 0),
+            })
+        self.metrics.reset()
+        if self.unknown_keys:
+            Domoticz.Debug(f"    fields without units: "
+                           f"{', '.join(sorted(f'{category}.{key}' for category, key in self.unknown_keys))}")
+
+        if self.history is not None:
+            for line in self.history.summary('1h'):
+                Domoticz.Debug(f"    {line}")
+
+    def history_path(self):
+        return os.path.join(Parameters['HomeFolder'], f"history_{Parameters['HardwareID']}_{self.index + 1}.bin")
+
+    def load_history(self):
+        # Replayed samples are kept apart from the snapshot of the live device
+        path = self.history_path()
+        if self.history is None or self.offline or not os.path.exists(path):
+            return
+        try:
+            self.history.load(path)
+        except (OSError, ValueError, KeyError) as e:
+            Domoticz.Error(f"Cannot load history snapshot {path}: {str(e)}")
+
+    def save_history(self):
+        if self.history is None or self.offline:
+            return
+        try:
+            self.history.save(self.history_path())
+        except OSError as e:
+            Domoticz.Error(f"Cannot save history snapshot: {str(e)}")
+
+    def update_history(self, measures: dict, now):
+        self.history.add(now, measures)
+        averages = {}
+        for measure, name in (('Dust', 'Dust 1h'), ('Humidity', 'Humidity 1h')):
+            stats = self.history.stats(measure, '1h', now)
+            if stats is not None:
+                averages[name] = round(stats[2], 1)
+        self.publish('History', averages)
 
     def create_devices(self):
+        # Only units already reported by the device, others are created when their field first appears
         for unit in self.UNITS.values():
-            if unit.id not in Devices:
+            if unit.last_update is not None and unit.id not in Devices:
                 Domoticz.Device(**unit.dev_params).Create()
+        # Profiles may have been added, removed or renamed since the selector was created
+        if self.profile_unit_id in Devices:
+            options = self.UNITS_ID_KEYS[self.profile_unit_id].dev_params['Options']
+            if Devices[self.profile_unit_id].Options.get('LevelNames') != options['LevelNames']:
+                Domoticz.Log(f"{self.Venta.host}: profile levels changed to {options['LevelNames']}")
+                update_device(unit=self.profile_unit_id, opt=options)
+
+    def update_devices(self, parsed: dict, timestamp=None):
+        if len(parsed) > 0:
+            self.polls += 1
+            # Replayed documents carry the time they were received, time based stages use it instead of the clock
+            now = time.monotonic() if timestamp is None else timestamp
+            # Refresh all devices once per refresh_polls or refresh_interval, so they do not become stale in Domoticz
+            force = (self.refresh_polls > 0 and self.polls % self.refresh_polls == 0) or \
+                (self.refresh_interval > 0 and now - self.last_forced >= self.refresh_interval)
+            if force:
+                self.last_forced = now
+
+            # Measure sensors do not work when power is off, keep the last state if Power is missing
+            action = parsed.get('Action')
+            if isinstance(action, dict) and 'Power' in action:
+                self.power_on = bool(action['Power'])
+
+            # Walk the document once, fields may be missing or unknown depending on the firmware
+            for category, fields in parsed.items():
+                if not isinstance(fields, dict) or category in self.IGNORED_CATEGORIES:
+                    continue
+                units = self.UNITS_BY_KEY.get(category, {})
+                skip_measures = category == 'Measure' and not self.power_on
+                for key, value in fields.items():
+                    unit = units.get(key)
+                    if unit is None:
+                        if key not in units and (category, key) not in self.unknown_keys:
+                            self.unknown_keys.add((category, key))
+                            Domoticz.Debug(f"{self.Venta.host}: no unit for {category}.{key} = {value!r}")
+                        continue
+                    if skip_measures and key not in self.MEASURED_WHEN_OFF:
+                        continue
+                    try:
+                        written = unit.update_domoticz_dev(value, force)
+                    except (KeyError, ValueError, TypeError) as e:
+                        # Unexpected value, e.g. a level missing from the unit mapping, keep the other units going
+                        if (category, key) not in self.bad_values:
+                            self.bad_values.add((category, key))
+                            Domoticz.Error(f"{self.Venta.host}: cannot update {unit.name} from "
+                                           f"{category}.{key} = {value!r} ({type(e).__name__}: {str(e)})")
+                        continue
+                    if written:
+                        self.updates_written += 1
+                    else:
+                        self.updates_skipped += 1
+
+            Domoticz.Debug(f"{self.Venta.host} poll {self.polls}: devices updates written: {self.updates_written}, "
+                           f"skipped: {self.updates_skipped}")
+
+            # Stages below compute with the values, fields which are null or not numbers are left out
+            measures = parsed.get('Measure')
+            measures = {name: value for name, value in measures.items() if is_number(value)} \
+                if isinstance(measures, dict) else None
+            state = {name: value for name, value in action.items() if isinstance(value, (bool, int, float))} \
+                if isinstance(action, dict) else None
+
+            if measures is not None and state is not None:
+                # Missing measures count as 0, malformed ones would look like a large change
+                if all(name in measures or name not in parsed['Measure'] for name in ('Humidity', 'Dust')):
+                    self.scheduler.add_sample(now, state.get('Power', False),
+                                              measures.get('Humidity', 0), measures.get('Dust', 0))
+                # Measures are not valid while power is off
+                if self.history is not None and state.get('Power', False):
+                    self.update_history(measures, time.time() if timestamp is None else timestamp)
+                if self.controller is not None and 'Humidity' in measures:
+                    self.control_humidity(state, measures['Humidity'], now)
+
+            if self.profiles and isinstance(action, dict):
+                self.check_profile(action)
+
+            if self.derived is not None and self.power_on and measures is not None:
+                started = time.perf_counter()
+                self.publish('Derived', self.derived.update(now, measures, state or {}))
+                self.metrics.observe('derived', time.perf_counter() - started)
+
+    def check_profile(self, state):
+        # State is outdated while actions are waiting for the device
+        if self.pending_actions or self.write_sent_at is not None:
+            return
+        if self.profile_check is not None:
+            name, actions = self.profiles[self.profile_check - 1]
+            differences = {action_name: state.get(action_name) for action_name, value in actions.items()
+                           if state.get(action_name) != value}
+            if differences:
+                Domoticz.Error(f"{self.Venta.host}: profile {name} not applied, device reports {str(differences)}")
+            else:
+                Domoticz.Log(f"{self.Venta.host}: profile {name} applied")
+            self.profile_check = None
+        # Selector shows the first profile matching the state, the device may be changed outside Domoticz
+        level = next((index for index, (_, actions) in enumerate(self.profiles, 1)
+                      if all(state.get(action_name) == value for action_name, value in actions.items())), 0)
+        self.publish('Profile', {'Profile': level})
+
+    def apply_profile(self, level):
+        index = level // 10
+        if not 0 < index <= len(self.profiles):
+            return
+        name, actions = self.profiles[index - 1]
+        Domoticz.Log(f"{self.Venta.host}: applying profile {name}: {str(actions)}")
+        self.queue_actions(actions)
+        self.publish('Profile', {'Profile': index})
+        self.profile_check = index
+
+    def control_humidity(self, state, humidity, now):
+        # Replayed state is not a device which could be controlled, its commands would never be sent
+        if self.offline:
+            return
+        # Commands already waiting for the device would make the state outdated
+        if self.pending_actions or self.write_sent_at is not None:
+            return
+        actions = self.controller.update(now, state, humidity)
+        if actions:
+            Domoticz.Log(f"{self.Venta.host}: humidity {humidity}%, target {self.controller.target}%, "
+                         f"setting {str(actions)}")
+            self.queue_actions(actions)
+
+    def connections(self):
+        suffix = f" {self.index + 1}" if self.index else ""
+        self.conn = Domoticz.Connection(Name="READ" + suffix, Transport="TCP/IP", Protocol="None",
+                                        Address=self.Venta.host, Port=str(self.Venta.port))
+        self.conn_write = Domoticz.Connection(Name="WRITE" + suffix, Transport="TCP/IP", Protocol="None",
+                                              Address=self.Venta.host, Port=str(self.Venta.port))
+        return self.conn, self.conn_write
+
+    def disconnect(self):
+        for connection in (self.conn, self.conn_write):
+            if connection.Connected() or connection.Connecting():
+                connection.Disconnect()
+
+    def send_actions(self):
+        # Only one Action request is sent at a time, commands received meanwhile are merged into the next one
+        if not self.pending_actions or self.write_sent_at is not None:
+            return
+        if self.conn_write.Connected():
+            Domoticz.Debug(f"Sending actions to {self.Venta.host}: {str(self.pending_actions)}")
+            self.send(self.conn_write, self.Venta.set_params(self.pending_actions))
+            self.sent_actions, self.pending_actions = self.pending_actions, {}
+            self.write_sent_at = time.monotonic()
+        elif not self.conn_write.Connecting():
+            self.connect(self.conn_write)
+
+    def requeue_sent_actions(self):
+        # Action request got no response, send its actions again unless newer values were queued meanwhile
+        self.pending_actions = dict(self.sent_actions, **self.pending_actions)
+        self.sent_actions = {}
+        self.write_sent_at = None
+
+    def send(self, connection, message):
+        if self.capture is not None:
+            self.capture.write(CaptureWriter.SENT, connection.Name, message)
+        connection.Send(message)
+
+    def connect(self, connection):
+        if self.offline or not self.health.allow(time.monotonic()):
+            return
+        if self.polls > 0:
+            self.metrics.count('reconnects')
+        connection.Connect()
+
+    def connection_failed(self, reason):
+        was_open = self.health.is_open()
+        self.health.failure(time.monotonic())
+        Domoticz.Debug(f"{self.Venta.host}: {reason}, failure {self.health.failures}, "
+                       f"next attempt in {self.health.next_attempt - time.monotonic():.0f} s")
+        if self.health.is_open() and not was_open:
+            Domoticz.Error(f"{self.Venta.host} does not respond, marking devices as timed out")
+            self.set_timed_out(1)
+        if self.discovery is not None and self.resolve_after > 0 and self.health.failures % self.resolve_after == 0:
+            self.start_resolve()
+
+    def start_resolve(self):
+        if self.resolver is not None or not self.Venta.mac_address:
+            return
+        Domoticz.Debug(f"Looking for {self.Venta.mac_address} in the LAN")
+        # Probe with the device's own request, it carries its MAC address and hash
+        self.resolver = threading.Thread(target=self.resolve_address, args=(self.Venta.get_info_str(),),
+                                         name=f"resolve {self.Venta.mac_address}", daemon=True)
+        self.resolver.start()
+
+    def resolve_address(self, message):
+        # Runs in the resolver thread, Domoticz API must not be used here
+        self.resolved_address = self.discovery.resolve(self.Venta.mac_address, message)
+
+    def stop_resolve(self, timeout):
+        if self.resolver is not None:
+            self.resolver.join(timeout)
+            if self.resolver.is_alive():
+                Domoticz.Error(f"Search for {self.Venta.mac_address} did not stop within {timeout:.0f} s")
+
+    def apply_resolved_address(self):
+        if self.resolver is None or self.resolver.is_alive():
+            return
+        address, self.resolver, self.resolved_address = self.resolved_address, None, None
+        if address is None:
+            Domoticz.Debug(f"{self.Venta.mac_address} not found in the LAN")
+            return
+        host, port = address
+        if (host, port) == (self.Venta.host, self.Venta.port):
+            return
+        Domoticz.Status(f"{self.Venta.mac_address} moved from {self.Venta.host}:{self.Venta.port} to {host}:{port}")
+        # Requests to the old address are not failures of the new one
+        self.polls_in_flight.cancel()
+        self.requeue_sent_actions()
+        self.Venta.host, self.Venta.port = host, port
+        self.health.retry_now()
+        # Drop the old connections first, their callbacks are ignored from now on
+        old_connections = (self.conn, self.conn_write)
+        self.conn = self.conn_write = None
+        for connection in old_connections:
+            if connection.Connected() or connection.Connecting():
+                connection.Disconnect()
+        self.connections()
+        self.request_info()
+
+    def connection_succeeded(self):
+        if self.health.is_open():
+            Domoticz.Status(f"{self.Venta.host} responds again")
+            self.set_timed_out(0)
+        self.health.success()
+
+    def set_timed_out(self, timed_out):
+        for unit in self.UNITS.values():
+            if unit.id in Devices and Devices[unit.id].TimedOut != timed_out:
+                update_device(unit.id, timed_out=timed_out)
+
+    def request_info(self):
+        if self.conn.Connected():
+            if not self.polls_in_flight.can_send():
+                # Previous poll is answered or cancelled at its deadline, requests must not pile up
+                Domoticz.Debug(f"{self.Venta.host}: previous poll not answered yet, not sending another")
+                return
+            self.send(self.conn, self.Venta.get_info_str())
+            now = time.monotonic()
+            self.polls_in_flight.sent(now)
+            self.scheduler.polled(now)
+        elif not self.conn.Connecting():
+            self.connect(self.conn)
+
+    def cancel_expired_poll(self, now) -> bool:
+        if not self.polls_in_flight.expired(now):
+            return False
+        self.metrics.count('missed_polls', self.polls_in_flight.cancel())
+        self.connection_failed(f"poll not answered within {self.polls_in_flight.timeout:.0f} s")
+        # Answer may still come on this connection, start over on a new one
+        if self.conn.Connected() or self.conn.Connecting():
+            self.conn.Disconnect()
+        return True
 
-    def update_devices(self, data: str = ''):
-        if data is '':
+    def owns(self, connection):
+        # Connections replaced after the device moved may still report, they share the names of the new ones
+        return connection is self.conn or connection is self.conn_write
+
+    def on_connect_failed(self, connection, description):
+        if not self.owns(connection):
             return
-        last_eol = data.rfind('\n')
-        data = data[last_eol + 1:-1]
-        parsed = json.loads(data)
-        if len(parsed) > 0:
-            def update_device_if_in_data(device, parsed):
-                if device.category in parsed:
-                    device.update_domoticz_dev(parsed)
+        self.connection_failed(f"{connection.Name} connection failed ({description})")
 
-            # Measure sensors do not work when power is off
-            # Update power and use it's nValue to skip sensors update
-            power_device = self.UNITS['Power']
+    def on_connect(self, connection):
+        if not self.owns(connection):
+            return
+        self.decoders[connection.Name] = FrameDecoder()
 
-            update_device_if_in_data(power_device, parsed)
-            power_device_state = Devices[power_device.id].nValue
-            fan_rpm_id = self.UNITS['FanRpm'].id
+        if connection is self.conn_write:
+            self.send_actions()
+        else:
+            self.request_info()
 
-            for device in self.UNITS.values():
-                if device.name == 'Power':
-                    # Power is updated outside the for
+    def on_disconnect(self, connection):
+        if not self.owns(connection):
+            return
+        if connection is self.conn and self.polls_in_flight.pending:
+            self.metrics.count('missed_polls', self.polls_in_flight.cancel())
+            self.connection_failed("connection closed before poll was answered")
+        if connection is self.conn_write:
+            if self.write_sent_at is not None:
+                self.requeue_sent_actions()
+                self.connection_failed("connection closed before Action request was answered")
+            self.send_actions()
+
+    def on_message(self, connection, data, timestamp=None):
+        if not self.owns(connection):
+            Domoticz.Debug(f"Ignoring data from replaced connection {connection.Name}")
+            return
+        if self.capture is not None:
+            self.capture.write(CaptureWriter.RECEIVED, connection.Name, data)
+        decoder = self.decoders.setdefault(connection.Name, FrameDecoder())
+        started = time.perf_counter()
+        documents = decoder.feed(data)
+        self.metrics.observe('parse', time.perf_counter() - started)
+        for document in documents:
+            if connection is self.conn and not self.offline:
+                request = self.polls_in_flight.answered()
+                if request is None:
+                    # Answer of a cancelled poll
+                    self.metrics.count('late_responses')
                     continue
-                if device.category == 'Measure' and device.id != fan_rpm_id and power_device_state == 0:
-                    # Do not update Measure sensor when power is off
+                self.connection_succeeded()
+                self.metrics.observe('poll_rtt', time.monotonic() - request.sent_at)
+                if request.stale:
+                    # Poll was sent before the last Action was answered, read the state again
+                    self.metrics.count('stale_responses')
+                    self.request_info()
                     continue
+            else:
+                self.connection_succeeded()
+            started = time.perf_counter()
+            self.update_devices(document, timestamp)
+            self.metrics.observe('update_devices', time.perf_counter() - started)
+            if connection is self.conn_write:
+                self.write_sent_at = None
+                self.sent_actions = {}
+                self.polls_in_flight.invalidate()
+                self.send_actions()
+                # Read back the state right after the change instead of waiting for the heartbeat
+                self.request_info()
+
+    def on_command(self, unit_id, command, level):
+        if unit_id == self.profile_unit_id:
+            self.apply_profile(level)
+            return
+        target_method = self.command_handlers.get((unit_id, command))
+        if target_method is None:
+            action = self.UNITS_ID_KEYS[unit_id].name
+            action_class = self.Venta.handler(action)
+            target_method = getattr(action_class, str(command).lower().replace(" ", "_"))
+            self.command_handlers[(unit_id, command)] = target_method
+        action_name, value = target_method(level)
+        if action_name is None:
+            return
+        self.queue_action(action_name, value)
+
+    def queue_action(self, action_name, value):
+        self.queue_actions({action_name: value})
+
+    def queue_actions(self, actions: dict):
+        # Actions queued together go out in one Action request
+        self.pending_actions.update(actions)
+        self.send_actions()
+        deadline = time.monotonic() + self.EXPECTED_VALUE_HOLD
+        for action_name, value in actions.items():
+            if action_name in self.UNITS:
+                self.UNITS[action_name].set_expected(value, deadline)
+        self.scheduler.speed_up(time.monotonic())
+
+    def on_heartbeat(self, now):
+        self.apply_resolved_address()
+        # Connection just recycled, poll on the next heartbeat
+        recycled = self.cancel_expired_poll(now)
+        if self.write_sent_at is not None and now - self.write_sent_at > self.WRITE_TIMEOUT:
+            Domoticz.Debug(f"No response to the Action request from {self.Venta.host}, reconnecting WRITE connection")
+            self.requeue_sent_actions()
+            self.connection_failed(f"Action request not answered within {self.WRITE_TIMEOUT} s")
+            self.conn_write.Disconnect()
+        else:
+            self.send_actions()
 
-                update_device_if_in_data(device, parsed)
+        if self.scheduler.due(now) and not recycled:
+            self.request_info()
+
+    def on_timeout(self, connection):
+        if not self.owns(connection):
+            if connection.Connected() or connection.Connecting():
+                connection.Disconnect()
+            return
+        self.metrics.count('timeouts')
+        self.connection_failed(f"{connection.Name} connection timed out")
+        if connection.Connected() or connection.Connecting():
+            connection.Disconnect()
 
-    def onStart(self):
-        if Parameters["Mode6"] != "0":
-            Domoticz.Debugging(int(Parameters["Mode6"]))
-            DumpConfigToLog()
 
-        self.prepare_devices_list()
+class BasePlugin:
+    def __init__(self):
+        self.devices = []
+        # Connection name and unit ID to the VentaDevice owning it
+        self.connections = {}
+        self.UNITS_ID_KEYS = {}
 
-        self.host = Parameters['Address']
-        self.port = Parameters['Port']
-        mac = Parameters['Mode1']
-        hash = Parameters['Mode3']
-        app_name = Parameters['Mode4']
+        self.options = {}
+        self.capture = None
+        self.replay = None
+        self.discovery = None
+        self.log_handler = None
+        # Timing of Domoticz callbacks
+        self.metrics = Metrics()
+        self.stats_interval = 300
+        self.next_stats = 0
 
-        self.Venta = VentaAPI(mac, self.host, self.port, hash=hash, app_name=app_name)
-        for method_name, val in VentaAPI.command_dict.items():
-            setattr(VentaAPI, method_name, val[0](self.Venta, method_name, val[1]))
+    def create_devices(self):
+        for device in self.devices:
+            device.create_devices()
 
-        Domoticz.Heartbeat(int(Parameters['Mode2']))
+    @timed('onStart')
+    def onStart(self):
+        if Parameters["Mode6"] != "0":
+            Domoticz.Debugging(int(Parameters["Mode6"]))
+            if int(Parameters["Mode6"]) & DEBUG_MESSAGES:
+                DumpConfigToLog()
+
+        venta_logger = logging.getLogger('venta')
+        # Handler of an earlier start forwards to a thread which is gone
+        for handler in list(venta_logger.handlers):
+            if type(handler).__name__ == 'DomoticzLogHandler':
+                venta_logger.removeHandler(handler)
+        self.log_handler = DomoticzLogHandler()
+        venta_logger.addHandler(self.log_handler)
+        venta_logger.setLevel(logging.DEBUG if Parameters["Mode6"] != "0" else logging.ERROR)
+
+        self.options = parse_options(Parameters.get('Mode5', ''))
+        refresh_polls = int(self.options.get('refresh_polls', 20))
+        refresh_interval = float(self.options.get('refresh_interval', 1800))
+        interval = int(Parameters['Mode2'])
+        min_interval = int(self.options.get('poll_min', 5))
+        max_interval = int(self.options.get('poll_max', 300))
+        diagnostics = self.options.get('diagnostics', '0') == '1'
+        self.stats_interval = int(self.options.get('stats_interval', self.stats_interval))
+        breaker_threshold = int(self.options.get('breaker_threshold', 5))
+        backoff_max = float(self.options.get('backoff_max', 300))
+        history_samples = int(self.options.get('history_samples', 720))
+        history = self.options.get('history', '0') == '1'
+        humidity_control = self.options.get('hum_control', '0') == '1'
+        if 'record' in self.options and 'replay' not in self.options:
+            try:
+                self.capture = CaptureWriter(os.path.join(Parameters['HomeFolder'], self.options['record']))
+            except OSError as e:
+                Domoticz.Error(f"Cannot open capture file {self.options['record']}, not recording: {str(e)}")
+        derived = split_list(self.options.get('derived', ''))
+        for metric in derived:
+            if metric not in DerivedMetrics.METRICS:
+                Domoticz.Error(f"Unknown derived metric {metric}, known: {', '.join(DerivedMetrics.METRICS)}")
+        derived = [metric for metric in derived if metric in DerivedMetrics.METRICS]
+        profiles = []
+        for key, value in self.options.items():
+            if key.startswith('profile_'):
+                try:
+                    profiles.append((key[len('profile_'):], parse_profile(value)))
+                except ValueError as e:
+                    Domoticz.Error(f"Profile {key[len('profile_'):]} ignored: {str(e)}")
+        if self.options.get('discover') and 'replay' not in self.options:
+            self.discovery = VentaDiscovery(expand_hosts(self.options['discover']),
+                                            split_list(self.options.get('discover_ports', Parameters['Port'])),
+                                            float(self.options.get('discover_timeout', 0.5)),
+                                            int(self.options.get('discover_concurrency', 64)),
+                                            os.path.join(Parameters['HomeFolder'], f"hosts_{Parameters['HardwareID']}.json"))
+        if 'replay' in self.options:
+            try:
+                self.replay = CaptureReplay(os.path.join(Parameters['HomeFolder'], self.options['replay']),
+                                            float(self.options.get('replay_speed', 1)))
+            except (OSError, ValueError) as e:
+                Domoticz.Error(f"Cannot replay {self.options['replay']}: {str(e)}")
+
+        # Several purifiers may be configured as comma separated lists, missing mac/hash repeat the last one
+        hosts = split_list(Parameters['Address'])
+        macs = split_list(Parameters['Mode1'])
+        hashes = split_list(Parameters['Mode3'])
+        max_devices = 255 // VentaDevice.UNITS_PER_DEVICE
+        if len(hosts) > max_devices:
+            Domoticz.Error(f"Only {max_devices} devices are supported, ignoring: {', '.join(hosts[max_devices:])}")
+            hosts = hosts[:max_devices]
+
+        device_macs = [macs[min(index, len(macs) - 1)] if macs else '' for index in range(len(hosts))]
+
+        now = time.monotonic()
+        for index, host in enumerate(hosts):
+            mac = device_macs[index]
+            hash = hashes[min(index, len(hashes) - 1)] if hashes else ''
+            venta = VentaAPI(mac, host, Parameters['Port'], hash=hash, app_name=Parameters['Mode4'])
+            # A shared mac does not identify the device, discovery would move it to another device's address
+            discovery = self.discovery
+            if discovery is not None and (not mac or [known.lower() for known in device_macs].count(mac.lower()) > 1):
+                Domoticz.Status(f"{host}: no unique mac address, not looked for in the LAN")
+                discovery = None
+            cached_address = discovery.lookup(mac) if discovery is not None else None
+            if cached_address is not None and cached_address != (venta.host, venta.port):
+                Domoticz.Status(f"{mac} was last found at {cached_address[0]}:{cached_address[1]}, not {host}")
+                venta.host, venta.port = cached_address
+            scheduler = PollScheduler(interval, min_interval, max_interval)
+            # First device is polled at once, others are spread over the interval, so they are not connected
+            # at the same heartbeat
+            scheduler.next_poll = now + index * interval / len(hosts)
+
+            device = VentaDevice(index, venta, scheduler, refresh_polls, refresh_interval=refresh_interval,
+                                 name_prefix=f"{host} " if len(hosts) > 1 else '', diagnostics=diagnostics,
+                                 health=ConnectionHealth(breaker_threshold, backoff_max),
+                                 history=MeasureHistory(history_samples) if history else None,
+                                 controller=HumidityController(int(self.options.get('hum_target', 50)),
+                                                               int(self.options.get('hum_band', 3)),
+                                                               int(self.options.get('hum_interval', 300)))
+                                 if humidity_control else None,
+                                 capture=self.capture, offline=self.replay is not None,
+                                 discovery=discovery, resolve_after=int(self.options.get('discover_after', 3)),
+                                 disabled_groups=split_list(self.options.get('disable_groups', '')),
+                                 profiles=profiles,
+                                 derived=DerivedMetrics(derived, float(self.options.get('dust_tau', 600)))
+                                 if derived else None,
+                                 poll_timeout=float(self.options.get('poll_timeout', 10)))
+            device.prepare_devices_list()
+            device.load_history()
+            self.devices.append(device)
+            for unit_id in device.UNITS_ID_KEYS:
+                self.UNITS_ID_KEYS[unit_id] = device
+            for connection in device.connections():
+                self.connections[connection.Name] = device
+
+        # Heartbeat is only a tick for the scheduler, keep it below the Domoticz 30 s limit
+        Domoticz.Heartbeat(CaptureReplay.HEARTBEAT if self.replay is not None else min(min_interval, interval, 30))
 
         self.create_devices()
 
-        self.conn = Domoticz.Connection(Name="READ", Transport="TCP/IP", Protocol="None",
-                                        Address=self.host, Port=self.port)
-        self.conn.Connect()
-
+        self.next_stats = now + self.stats_interval
+        if self.replay is not None:
+            # Replayed from onHeartbeat, in slices
+            Domoticz.Status(f"Replaying {self.options['replay']}")
+            return
+        for device in self.devices:
+            device.on_heartbeat(now)
+
+    def replay_capture(self, now):
+        deadline = time.perf_counter() + CaptureReplay.SLICE
+        for timestamp, direction, name, data in self.replay.due_records(now):
+            if direction == CaptureWriter.RECEIVED and name in self.connections:
+                device = self.connections[name]
+                device.on_message(device.conn if name == device.conn.Name else device.conn_write, data, timestamp)
+            if time.perf_counter() >= deadline:
+                # Rest on the next heartbeat
+                return
+        if self.replay.finished:
+            Domoticz.Status(f"Replay of {self.options['replay']} finished")
+            self.replay = None
+
+    @timed('onStop')
     def onStop(self):
-        if self.conn.Connected() or self.conn.Connecting():
-            self.conn.Disconnect()
+        if self.discovery is not None:
+            self.discovery.stop()
+        for device in self.devices:
+            if self.discovery is not None:
+                # Probes already started end within the discovery timeout
+                device.stop_resolve(self.discovery.timeout + 1)
+            device.disconnect()
+            device.save_history()
+        if self.log_handler is not None:
+            self.log_handler.forward_queued()
+        if self.capture is not None:
+            self.capture.close()
         Domoticz.Debug("onStop - Plugin is stopping.")
 
+    @timed('onDisconnect')
     def onDisconnect(self, Connection):
         Domoticz.Debug(f"onDisconnect called for Connection "
                        f"{Connection.Name} to: {Connection.Address}:{Connection.Port}")
+        if Connection.Name in self.connections:
+            self.connections[Connection.Name].on_disconnect(Connection)
 
+    @timed('onConnect')
     def onConnect(self, Connection, status, Description):
         Domoticz.Debug(f"onConnect called for Connection {Connection.Name} to: {Connection.Address}:{Connection.Port}")
         Domoticz.Debug(f"onConnect status: {str(status)}, Description: {str(Description)}")
         
         if not Connection.Connected():
             Domoticz.Debug(f"onConnect status: {str(status)}, Description: {str(Description)}")
+            if Connection.Name in self.connections:
+                self.connections[Connection.Name].on_connect_failed(Connection, Description)
             return
         
-        if Connection.Name == "WRITE":
-            while not self.commandToSend.empty():
-                Connection.Send(self.commandToSend.get())
-        elif Connection.Name == "READ":
-            self.conn.Send(self.Venta.get_info_str())
+        if Connection.Name in self.connections:
+            self.connections[Connection.Name].on_connect(Connection)
 
+    @timed('onMessage')
     def onMessage(self, Connection, Data):
         Domoticz.Debug(f"onMessage called for connection {Connection.Name} to: {Connection.Address}:{Connection.Port}")
-        self.update_devices(Data.decode())
+        if Connection.Name in self.connections:
+            self.connections[Connection.Name].on_message(Connection, Data)
 
+    @timed('onCommand')
     def onCommand(self, Unit, Command, Level, Hue):
         Domoticz.Debug(f"onCommand called for Unit: {str(Unit)}, Command {str(Command)}, Level: {str(Level)}")
         if Unit in self.UNITS_ID_KEYS:
-            action = self.UNITS_ID_KEYS[Unit].name
-            action_class = getattr(self.Venta, action)
-            target_method = getattr(action_class, str(Command).lower().replace(" ", "_"))
-            message = target_method(Level)
-
-            self.commandToSend.put(message)
-            self.conn_write = Domoticz.Connection(Name="WRITE", Transport="TCP/IP", Protocol="None",
-                                       Address=self.host, Port=self.port)
-
-            self.conn_write.Connect()
+            self.UNITS_ID_KEYS[Unit].on_command(Unit, Command, Level)
 
+    @timed('onHeartbeat')
     def onHeartbeat(self):
         Domoticz.Debug("onHeartbeat called.")
-        if self.conn.Connected():
-            self.conn.Send(self.Venta.get_info_str())
+        self.log_handler.forward_queued()
+        now = time.monotonic()
+        if self.replay is not None:
+            self.replay_capture(now)
         else:
-            if not self.conn.Connecting():
-                self.conn.Connect()
-
+            for device in self.devices:
+                device.on_heartbeat(now)
+
+        if now >= self.next_stats:
+            self.next_stats = now + self.stats_interval
+            self.publish_metrics()
+
+    def publish_metrics(self):
+        Domoticz.Debug("Callbacks statistics:")
+        for line in self.metrics.summary():
+            Domoticz.Debug(f"    {line}")
+        self.metrics.reset()
+        for device in self.devices:
+            device.publish_metrics()
+            # Keep snapshot fresh in case Domoticz is not stopped cleanly
+            device.save_history()
+
+    @timed('onTimeout')
     def onTimeout(self, Connection):
         Domoticz.Debug(f"onTimeout called for connection to: {Connection.Address}: {Connection.Port}")
-        if self.conn.Connected() or self.conn.Connecting():
-            self.conn.Disconnect()
+        if Connection.Name in self.connections:
+            self.connections[Connection.Name].on_timeout(Connection)
 
 
 global _plugin
@@ -486,7 +1788,6 @@ def update_device(unit,
         args["SignalLevel"] = sig_lvl
     if bat_lvl != -1:
         args["BatteryLevel"] = bat_lvl
-    opt = str(opt)
     if len(opt) > 0:
         args["Options"] = opt
     if timed_out != -1:
@@ -518,6 +1819,32 @@ def update_device(unit,
 
 
 # Generic helper functions
+class DomoticzLogHandler(logging.Handler):
+    # Forwards log records of the venta module to the Domoticz log. Domoticz API may only be used from the
+    # thread calling the plugin, records of other threads (e.g. discovery) wait for forward_queued()
+    def __init__(self):
+        super().__init__()
+        self.thread = threading.get_ident()
+        self.queued = collections.deque()
+
+    def emit(self, record):
+        if threading.get_ident() != self.thread:
+            self.queued.append((record.levelno, self.format(record)))
+            return
+        self.forward(record.levelno, self.format(record))
+
+    @staticmethod
+    def forward(level, message):
+        if level >= logging.ERROR:
+            Domoticz.Error(message)
+        else:
+            Domoticz.Debug(message)
+
+    def forward_queued(self):
+        while self.queued:
+            self.forward(*self.queued.popleft())
+
+
 def DumpConfigToLog():
     for x in Parameters:
         if Parameters[x] != "":
@@ -0,0 +1,41 @@
+# Fixtures shared by the tests: fake device and the plugin driven by the Domoticz stub
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from harness import domoticz_stub as stub  # noqa: E402
+from harness.fake_venta import FakeVenta  # noqa: E402
+
+
+@pytest.fixture
+def venta():
+    server = FakeVenta().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def start_plugin(venta, tmp_path):
+    """Loads plugin.py for the fake device and waits for the first answered poll.
+
+    Options are passed as Mode5 "name=value" pairs, returns the plugin module and its VentaDevice.
+    """
+    started = []
+
+    def start(**options):
+        host, port = venta.address
+        plugin = stub.load_plugin({'Address': host, 'Port': str(port), 'HomeFolder': str(tmp_path),
+                                   'Mode5': ';'.join(f"{name}={value}" for name, value in options.items())})
+        plugin.onStart()
+        started.append(plugin)
+        device = plugin._plugin.devices[0]
+        assert stub.run_until(lambda: device.polls > 0)
+        return plugin, device
+
+    yield start
+    for plugin in started:
+        plugin.onStop()
+    stub.reset()
@@ -0,0 +1,465 @@
+import copy
+import json
+import logging
+import threading
+import time
+
+import pytest
+
+from harness import domoticz_stub as stub
+from harness.fake_venta import FakeVenta
+from venta import CaptureWriter
+
+
+@pytest.fixture(scope='module')
+def plugin():
+    return stub.load_plugin()
+
+
+def test_scheduler_backs_off_while_stable(plugin):
+    scheduler = plugin.PollScheduler(10, 5, 80)
+    scheduler.polled(0)
+    assert scheduler.next_poll == 10
+    scheduler.add_sample(0, True, 45, 3)
+    for expected in (20, 40, 80, 80):
+        scheduler.add_sample(0, True, 45, 3)
+        assert scheduler.interval == expected
+    # Small change of the measures returns to the base interval
+    scheduler.add_sample(0, True, 46, 3)
+    assert scheduler.interval == 10
+    scheduler.add_sample(0, False, 46, 3)
+    assert scheduler.interval == 20
+
+
+def test_scheduler_polls_fast_after_large_change(plugin):
+    scheduler = plugin.PollScheduler(30, 5, 300)
+    scheduler.add_sample(0, True, 45, 3)
+    scheduler.add_sample(0, True, 45, 3)
+    scheduler.polled(100)
+    assert scheduler.next_poll == 160
+    scheduler.add_sample(101, True, 50, 3)
+    assert (scheduler.interval, scheduler.next_poll) == (30, 106)
+    for now in (106, 111):
+        scheduler.polled(now)
+        assert scheduler.next_poll == now + 5
+    scheduler.polled(116)
+    assert scheduler.next_poll == 146
+
+
+def test_devices_connect_spread_over_interval():
+    first = FakeVenta(host='127.0.0.1').start()
+    port = first.address[1]
+    second = FakeVenta(host='127.0.0.2', port=port).start()
+    plugin = stub.load_plugin({'Address': '127.0.0.1,127.0.0.2', 'Port': str(port), 'Mode2': '20'})
+    try:
+        plugin.onStart()
+        devices = plugin._plugin.devices
+        assert devices[0].conn.Connecting() or devices[0].conn.Connected()
+        assert not (devices[1].conn.Connecting() or devices[1].conn.Connected())
+        assert devices[1].scheduler.next_poll - devices[0].scheduler.next_poll == pytest.approx(10, abs=1)
+        assert stub.run_until(lambda: devices[0].polls > 0)
+        assert second.requests['GET /Complete'] == 0
+    finally:
+        plugin.onStop()
+        stub.reset()
+        first.stop()
+        second.stop()
+
+
+def test_health_backs_off_and_opens(plugin, monkeypatch):
+    monkeypatch.setattr(plugin.random, 'uniform', lambda low, high: 1.0)
+    health = plugin.ConnectionHealth(threshold=3, max_delay=60)
+    assert health.allow(0)
+    for now, delay in ((0, 1), (10, 2)):
+        health.failure(now)
+        assert health.next_attempt == now + delay
+        assert not health.allow(now + delay - 0.1)
+        assert health.allow(now + delay)
+    assert not health.is_open()
+    health.failure(20)
+    assert (health.state, health.next_attempt) == (health.OPEN, 80)
+    # Single probe once the delay passes
+    assert health.allow(80)
+    assert health.state == health.HALF_OPEN
+    assert not health.allow(81)
+    health.success()
+    assert (health.state, health.failures) == (health.CLOSED, 0)
+    assert health.allow(81)
+
+
+def test_health_retry_now(plugin):
+    health = plugin.ConnectionHealth(threshold=1, max_delay=60)
+    health.failure(0)
+    assert health.allow(100)
+    health.retry_now()
+    assert health.state == health.OPEN
+    assert health.allow(0)
+
+
+def test_tracker_deadline(plugin):
+    tracker = plugin.RequestTracker(timeout=10, limit=1)
+    assert tracker.can_send()
+    tracker.sent(100)
+    assert not tracker.can_send()
+    assert not tracker.expired(109.9)
+    assert tracker.expired(110)
+    assert tracker.cancel() == 1
+    assert not tracker.expired(200)
+    assert tracker.can_send()
+
+
+def test_tracker_late_and_stale_answers(plugin):
+    tracker = plugin.RequestTracker(timeout=10, limit=2)
+    tracker.sent(1)
+    tracker.invalidate()
+    tracker.sent(2)
+    first, second = tracker.answered(), tracker.answered()
+    assert (first.sent_at, first.stale) == (1, True)
+    assert (second.sent_at, second.stale) == (2, False)
+    # Answer of a cancelled request
+    assert tracker.answered() is None
+
+
+def test_device_follows_fake_state(venta, start_plugin):
+    venta.set_measure(Humidity=61)
+    _, device = start_plugin()
+    polls = device.polls
+    device.request_info()
+    assert stub.run_until(lambda: device.polls > polls)
+    assert stub.Devices[device.UNITS['Humidity'].id].nValue == 61
+    assert stub.Devices[device.UNITS['FanSpeed'].id].nValue == 20
+
+
+def test_unchanged_values_are_not_written(venta, start_plugin):
+    _, device = start_plugin(refresh_polls=0, refresh_interval=60)
+    document = copy.deepcopy(venta.state)
+    written = device.updates_written
+    device.update_devices(document)
+    assert device.updates_written == written
+    # Refreshed once refresh_interval passes, even when nothing changed
+    device.last_forced -= 61
+    updates = stub.total_updates()
+    device.update_devices(document)
+    assert stub.total_updates() - updates == len([unit for unit in device.UNITS.values() if unit.last_update])
+
+
+def test_refresh_by_poll_count(venta, start_plugin):
+    _, device = start_plugin(refresh_polls=3, refresh_interval=0)
+    document = copy.deepcopy(venta.state)
+    updates = []
+    for _ in range(3):
+        before = stub.total_updates()
+        device.update_devices(document)
+        updates.append(stub.total_updates() - before)
+    assert updates.count(0) == 2
+    assert max(updates) > 0
+
+
+def test_bad_value_does_not_stop_dispatch(venta, start_plugin):
+    _, device = start_plugin(hum_control=1, history=1, derived='ewma,aqi,dewpoint,fan')
+    for _ in range(2):
+        device.update_devices({'Action': {'Power': True, 'TargetHum': 33, 'FanSpeed': [1]},
+                               'Measure': {'Humidity': 44}})
+    assert stub.Devices[device.UNITS['Humidity'].id].nValue == 44
+    errors = [message for _, level, message in stub.log if level == 'Error']
+    assert len(errors) == 2
+    assert 'Action.TargetHum = 33' in errors[0]
+    assert 'Action.FanSpeed = [1]' in errors[1]
+    # Later stages skip values they cannot compute with
+    device.update_devices({'Action': [], 'Measure': {'Humidity': 45}})
+    device.update_devices({'Action': {'Power': True}, 'Measure': {'Humidity': None, 'Dust': 'x', 'Temperature': 20}})
+    device.update_devices({'Action': {'Power': True, 'FanSpeed': None, 'Automatic': False},
+                           'Measure': {'Humidity': 20, 'Dust': 3}})
+    assert stub.Devices[device.UNITS['Humidity'].id].nValue == 20
+
+
+def test_bad_write_reply_completes_the_action(venta, start_plugin):
+    _, device = start_plugin()
+    device.write_sent_at = time.monotonic()
+    body = '{"Action": {"Power": true, "FanSpeed": null}, "Measure": {"Humidity": null}}'
+    device.on_message(device.conn_write, f"HTTP/1.1 200 OK\r\nContent-Length: {len(body)}\r\n\r\n{body}".encode())
+    assert device.write_sent_at is None
+
+
+def test_unknown_fields_are_recorded(venta, start_plugin):
+    _, device = start_plugin()
+    device.update_devices({'Measure': {'Humidity': 44, 'NewSensor': 1}})
+    assert ('Measure', 'NewSensor') in device.unknown_keys
+
+
+def test_command_is_sent_to_the_device(venta, start_plugin):
+    _, device = start_plugin()
+    stub.command(device.UNITS['TargetHum'].id, 'Set Level', 30)
+    assert stub.run_until(lambda: venta.state['Action']['TargetHum'] == 40)
+    assert stub.Devices[device.UNITS['TargetHum'].id].nValue == 30
+
+
+def test_profile_is_applied(venta, start_plugin):
+    _, device = start_plugin(profile_night='SleepMode:on,FanSpeed:1,ChildLock:on',
+                             profile_day='SleepMode:off,FanSpeed:3')
+    unit_id = device.profile_unit_id
+    assert stub.Devices[unit_id].Options['LevelNames'] == 'Custom|night|day'
+    stub.command(unit_id, 'Set Level', 10)
+    assert stub.run_until(lambda: device.profile_check is None and venta.requests['POST /Action'] > 0)
+    assert {name: venta.state['Action'][name] for name in ('SleepMode', 'FanSpeed', 'ChildLock')} == \
+        {'SleepMode': True, 'FanSpeed': 1, 'ChildLock': True}
+    assert stub.Devices[unit_id].nValue == 10
+    assert any(message.endswith('profile night applied') for _, _, message in stub.log)
+    # Changed outside Domoticz, no profile matches
+    venta.state['Action']['FanSpeed'] = 2
+    polls = device.polls
+    device.request_info()
+    assert stub.run_until(lambda: device.polls > polls)
+    assert stub.Devices[unit_id].nValue == 0
+
+
+def test_profile_levels_follow_options(venta, start_plugin):
+    _, device = start_plugin(profile_night='SleepMode:on')
+    unit_id = device.profile_unit_id
+    stub.Devices[unit_id].Options = dict(stub.Devices[unit_id].Options, LevelNames='Custom|old|removed')
+    device.create_devices()
+    assert stub.Devices[unit_id].Options['LevelNames'] == 'Custom|night'
+
+
+def test_replaced_connections_are_ignored(venta, start_plugin):
+    _, device = start_plugin(discover='127.0.0.1')
+    moved = FakeVenta(mac=venta.state['Header']['MacAdress']).start()
+    try:
+        moved.set_measure(Humidity=70)
+        old_connection = device.conn
+        device.resolver = threading.Thread(target=lambda: None)
+        device.resolver.start()
+        device.resolver.join()
+        device.resolved_address = moved.address
+        device.apply_resolved_address()
+        assert device.conn is not old_connection
+        assert stub.run_until(lambda: stub.Devices[device.UNITS['Humidity'].id].nValue == 70)
+        failures, polls = device.health.failures, device.polls
+        device.on_message(old_connection, b'{"Measure": {"Humidity": 10}}')
+        device.on_disconnect(old_connection)
+        device.on_connect_failed(old_connection, 'refused')
+        assert (device.health.failures, device.polls) == (failures, polls)
+        assert stub.Devices[device.UNITS['Humidity'].id].nValue == 70
+    finally:
+        moved.stop()
+
+
+def test_discover_after_zero_disables_search(venta, start_plugin):
+    _, device = start_plugin(discover='127.0.0.1', discover_after=0)
+    for _ in range(3):
+        device.connection_failed('refused')
+    assert device.resolver is None
+
+
+def test_stop_waits_for_search(venta, start_plugin):
+    plugin, device = start_plugin(discover='127.0.0.0/28', discover_timeout=0.5, discover_concurrency=2)
+    device.start_resolve()
+    started = time.monotonic()
+    plugin.onStop()
+    assert not device.resolver.is_alive()
+    assert time.monotonic() - started < 2
+
+
+def test_shared_mac_is_not_discovered(tmp_path):
+    mac = 'aa:bb:cc:dd:ee:01'
+    first = FakeVenta(host='127.0.0.1', mac=mac).start()
+    port = first.address[1]
+    second = FakeVenta(host='127.0.0.2', port=port, mac=mac).start()
+    (tmp_path / 'hosts_1.json').write_text(f'{{"127.0.0.1:{port}": "{mac}"}}')
+    plugin = stub.load_plugin({'Address': '127.0.0.1,127.0.0.2', 'Port': str(port), 'Mode1': mac,
+                               'HomeFolder': str(tmp_path), 'Mode2': '2', 'Mode5': 'discover=127.0.0.0/29'})
+    try:
+        plugin.onStart()
+        devices = plugin._plugin.devices
+        assert [device.Venta.host for device in devices] == ['127.0.0.1', '127.0.0.2']
+        assert all(device.discovery is None for device in devices)
+        assert stub.run_until(lambda: all(device.polls > 0 for device in devices))
+        assert second.requests['GET /Complete'] > 0
+    finally:
+        plugin.onStop()
+        stub.reset()
+        first.stop()
+        second.stop()
+
+
+def test_discovery_logs_from_plugin_thread(venta, start_plugin, monkeypatch):
+    plugin, device = start_plugin(discover='127.0.0.1', discover_timeout=0.2)
+    threads = []
+    debug = stub.Debug
+    monkeypatch.setattr(stub, 'Debug', lambda message: threads.append(threading.current_thread()) or debug(message))
+    logging.getLogger('venta').setLevel(logging.DEBUG)
+    try:
+        device.start_resolve()
+        device.resolver.join()
+    finally:
+        logging.getLogger('venta').setLevel(logging.ERROR)
+    assert all(thread is threading.current_thread() for thread in threads)
+    assert not any('Scanned' in message for _, _, message in stub.log)
+    plugin.onHeartbeat()
+    assert any('Scanned 1 addresses' in message for _, _, message in stub.log)
+
+
+def test_replay_uses_capture_time(tmp_path):
+    capture = tmp_path / 'venta.cap'
+    writer = CaptureWriter(str(capture))
+    for hour, dust in enumerate((10, 50, 90)):
+        body = json.dumps({'Action': {'Power': True}, 'Measure': {'Humidity': 40 + hour, 'Dust': dust}})
+        writer.write(CaptureWriter.RECEIVED, 'READ',
+                     f"HTTP/1.1 200 OK\r\nContent-Length: {len(body)}\r\n\r\n{body}".encode(), 1000000 + hour * 3600)
+    writer.close()
+    snapshot = tmp_path / 'history_1_1.bin'
+    snapshot.write_bytes(b'live')
+    plugin = stub.load_plugin({'HomeFolder': str(tmp_path),
+                               'Mode5': 'replay=venta.cap;replay_speed=0;history=1;derived=ewma;dust_tau=600'})
+    try:
+        plugin.onStart()
+        device = plugin._plugin.devices[0]
+        assert stub.run_until(lambda: plugin._plugin.replay is None, 5)
+        assert device.polls == 3
+        # An hour between samples, the average follows the last value
+        assert float(stub.Devices[device.UNITS['Dust EWMA'].id].sValue) > 89
+        assert device.history.stats('Dust', '1h', 1000000 + 2 * 3600)[3] == 1
+        plugin._plugin.publish_metrics()
+    finally:
+        plugin.onStop()
+        stub.reset()
+    assert snapshot.read_bytes() == b'live'
+
+
+@pytest.mark.parametrize('concentration, expected', [
+    (0, (0, 1, 'Good')),
+    (9.0, (50, 1, 'Good')),
+    (9.05, (50, 1, 'Good')),
+    (9.1, (51, 2, 'Moderate')),
+    (35.4, (100, 2, 'Moderate')),
+    (35.5, (101, 3, 'Unhealthy for sensitive groups')),
+    (55.5, (151, 3, 'Unhealthy')),
+    (125.5, (201, 4, 'Very unhealthy')),
+    (225.5, (301, 4, 'Hazardous')),
+    (325.4, (500, 4, 'Hazardous')),
+    (1000, (500, 4, 'Hazardous')),
+])
+def test_pm25_aqi_bands(plugin, concentration, expected):
+    assert plugin.pm25_aqi(concentration) == expected
+
+
+def test_dew_point(plugin):
+    assert plugin.dew_point(20, 50) == pytest.approx(9.3, abs=0.05)
+    assert plugin.dew_point(20, 100) == pytest.approx(20)
+
+
+@pytest.mark.parametrize('humidity', [-1, 0, 101, None])
+def test_dew_point_skips_impossible_humidity(plugin, humidity):
+    derived = plugin.DerivedMetrics(['dewpoint'])
+    assert derived.update(0, {'Temperature': 20, 'Humidity': humidity}, {}) == {}
+
+
+def test_rolling_mean_is_time_weighted(plugin):
+    mean = plugin.RollingMean(window=100, buckets=10, max_gap=50)
+    mean.add(0, 10)
+    assert mean.mean() is None
+    mean.add(10, 20)
+    assert mean.mean() == pytest.approx(10)
+    # 10 s of 10 and 20 s of 20
+    mean.add(30, 30)
+    assert mean.mean() == pytest.approx(50 / 3)
+    # Gap counts for max_gap only, earlier samples left the window
+    mean.add(200, 0)
+    assert (mean.mean(), mean.weight) == (pytest.approx(30), pytest.approx(50))
+
+
+def test_check_fan_learns_and_reports(plugin):
+    derived = plugin.DerivedMetrics(['fan'])
+    state = {'FanSpeed': 2, 'Boost': False, 'SleepMode': False}
+    # Fan is still changing its speed after a state change
+    assert derived.check_fan(state, 850) is None
+    assert [derived.check_fan(state, 850) for _ in range(5)] == [(0, 'Learning')] * 4 + [(1, 'Normal')]
+    assert derived.check_fan(state, 1500) == (3, '1500 RPM, expected 850')
+    # Anomaly is not learned
+    assert derived.check_fan(state, 860) == (1, 'Normal')
+    assert derived.check_fan(state, 0) == (4, 'Fan stopped')
+    assert derived.check_fan(dict(state, FanSpeed=3), 1200) is None
+
+
+MANUAL = {'Power': True, 'SleepMode': False, 'Automatic': False, 'FanSpeed': 3, 'Boost': False, 'TargetHum': 50}
+
+
+@pytest.mark.parametrize('humidity, expected', [
+    (46, {'FanSpeed': 4}),
+    (47, {}),
+    (50, {}),
+    (53, {}),
+    (54, {'FanSpeed': 2}),
+])
+def test_controller_band_edges(plugin, humidity, expected):
+    controller = plugin.HumidityController(target=50, band=3, min_interval=300)
+    assert controller.update(0, MANUAL, humidity) == expected
+
+
+def test_controller_rate_limit(plugin):
+    controller = plugin.HumidityController(target=50, band=3, min_interval=300)
+    assert controller.update(1000, MANUAL, 40) == {'FanSpeed': 4}
+    assert controller.update(1299, dict(MANUAL, FanSpeed=4), 40) == {}
+    assert controller.update(1300, dict(MANUAL, FanSpeed=4), 40) == {'FanSpeed': 5}
+    # No change, no wait for the next one
+    assert controller.update(1301, dict(MANUAL, FanSpeed=5, Boost=True), 40) == {}
+    assert controller.update(1600, dict(MANUAL, FanSpeed=5), 60) == {'FanSpeed': 4}
+
+
+def test_controller_sets_target_in_automatic_mode(plugin):
+    controller = plugin.HumidityController(target=52, band=3, min_interval=300)
+    automatic = dict(MANUAL, Automatic=True, TargetHum=40)
+    # Humidity is left to the device, only the nearest TargetHum level at or above the target is kept
+    assert controller.update(0, automatic, 30) == {'TargetHum': 55}
+    assert controller.update(300, dict(automatic, TargetHum=55), 30) == {}
+
+
+def test_controller_steps_through_boost(plugin):
+    controller = plugin.HumidityController(target=50, band=3, min_interval=0)
+    assert controller.update(0, dict(MANUAL, FanSpeed=5), 40) == {'Boost': True}
+    assert controller.update(0, dict(MANUAL, FanSpeed=5, Boost=True), 40) == {}
+    # Boost is the first step down
+    assert controller.update(0, dict(MANUAL, FanSpeed=5, Boost=True), 60) == {'Boost': False}
+    assert controller.update(0, dict(MANUAL, FanSpeed=2), 60) == {'FanSpeed': 1}
+    assert controller.update(0, dict(MANUAL, FanSpeed=1), 60) == {}
+
+
+@pytest.mark.parametrize('state', [dict(MANUAL, Power=False), dict(MANUAL, SleepMode=True),
+                                   dict(MANUAL, Automatic=True, Power=False)])
+def test_controller_leaves_device_alone(plugin, state):
+    controller = plugin.HumidityController(target=50, band=3, min_interval=0)
+    assert controller.update(0, state, 20) == {}
+    assert controller.update(0, state, 80) == {}
+    assert controller.last_change is None
+
+
+def test_controller_commands_the_device(venta, start_plugin):
+    venta.set_measure(Humidity=40)
+    start_plugin(hum_control=1, hum_target=50, hum_band=3)
+    assert stub.run_until(lambda: venta.state['Action']['FanSpeed'] == 3)
+    assert any('setting' in message for _, level, message in stub.log if level == 'Log')
+
+
+def test_dropped_action_is_sent_again(venta, start_plugin):
+    _, device = start_plugin()
+    venta.drop = 1.0
+    stub.command(device.UNITS['TargetHum'].id, 'Set Level', 30)
+    assert stub.run_until(lambda: device.health.failures > 0)
+    assert device.pending_actions == {'TargetHum': 40}
+    venta.drop = 0.0
+    device.health.retry_now()
+    device.send_actions()
+    assert stub.run_until(lambda: venta.state['Action']['TargetHum'] == 40)
+    assert device.pending_actions == device.sent_actions == {}
+
+
+def test_unanswered_action_is_queued_again(venta, start_plugin):
+    _, device = start_plugin()
+    venta.latency = 0.5
+    device.queue_actions({'TargetHum': 40, 'Boost': True})
+    assert stub.run_until(lambda: device.write_sent_at is not None)
+    device.queue_action('TargetHum', 45)
+    device.on_heartbeat(time.monotonic() + device.WRITE_TIMEOUT + 1)
+    # Newer value queued meanwhile wins
+    assert device.pending_actions == {'TargetHum': 45, 'Boost': True}
+    assert device.health.failures == 1
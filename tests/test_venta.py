@@ -0,0 +1,112 @@
+import json
+
+import pytest
+
+from harness.fake_venta import FakeVenta
+from venta import FrameDecoder, VentaAPI, VentaDiscovery
+
+DOCUMENT = {"Header": {"MacAdress": "aa:bb:cc:dd:ee:01"}, "Measure": {"Humidity": 45, "Dust": 3}}
+
+
+def response(document, content_length=None):
+    body = json.dumps(document)
+    length = len(body) if content_length is None else content_length
+    return f"HTTP/1.1 200 OK\r\nContent-Length: {length}\r\n\r\n{body}".encode()
+
+
+class RecordingVenta(FakeVenta):
+    """Fake device keeping request documents it received."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.documents = []
+
+    def handle_request_document(self, method, document):
+        self.documents.append(document)
+        return super().handle_request_document(method, document)
+
+
+@pytest.mark.parametrize('chunk', [1, 7, 64])
+def test_decoder_joins_split_response(chunk):
+    decoder = FrameDecoder()
+    data = response(DOCUMENT)
+    documents = []
+    for start in range(0, len(data), chunk):
+        documents += decoder.feed(data[start:start + chunk])
+    assert documents == [DOCUMENT]
+    assert not decoder.buffer
+
+
+def test_decoder_splits_coalesced_responses():
+    second = dict(DOCUMENT, Measure={"Humidity": 50, "Dust": 4})
+    decoder = FrameDecoder()
+    data = response(DOCUMENT) + response(second)
+    assert decoder.feed(data[:-10]) == [DOCUMENT]
+    assert decoder.feed(data[-10:]) == [second]
+
+
+@pytest.mark.parametrize('error', [50, -5, -2])
+def test_decoder_survives_wrong_content_length(error):
+    decoder = FrameDecoder()
+    content_length = len(json.dumps(DOCUMENT)) + error
+    assert decoder.feed(response(DOCUMENT, content_length)) == [DOCUMENT]
+    assert decoder.feed(response(DOCUMENT)) == [DOCUMENT]
+    assert decoder.discarded == 0
+
+
+def test_decoder_discards_garbage():
+    decoder = FrameDecoder()
+    assert decoder.feed(b'garbage' * 300) == []
+    assert decoder.discarded == 1
+    assert decoder.feed(b'{"a": }' + response(DOCUMENT)) == [DOCUMENT]
+
+
+@pytest.fixture
+def devices():
+    # Same port on several loopback addresses, as devices in a LAN
+    first = RecordingVenta(host='127.0.0.2', mac='aa:bb:cc:dd:ee:02').start()
+    port = first.address[1]
+    servers = [first, RecordingVenta(host='127.0.0.3', port=port, mac='aa:bb:cc:dd:ee:03').start()]
+    yield servers
+    for server in servers:
+        server.stop()
+
+
+def test_discovery_scan_finds_devices(devices, tmp_path):
+    port = devices[0].address[1]
+    cache_path = tmp_path / 'hosts.json'
+    discovery = VentaDiscovery([f'127.0.0.{n}' for n in range(1, 6)], [port], 0.3, 4, str(cache_path))
+    found = discovery.scan()
+    assert found == {'aa:bb:cc:dd:ee:02': ('127.0.0.2', port), 'aa:bb:cc:dd:ee:03': ('127.0.0.3', port)}
+    assert json.loads(cache_path.read_text()) == {f'127.0.0.2:{port}': 'aa:bb:cc:dd:ee:02',
+                                                  f'127.0.0.3:{port}': 'aa:bb:cc:dd:ee:03'}
+    assert VentaDiscovery([], [port], cache_path=str(cache_path)).lookup('AA:BB:CC:DD:EE:03') == ('127.0.0.3', port)
+
+
+def test_discovery_probes_with_the_device_request(devices):
+    port = devices[0].address[1]
+    discovery = VentaDiscovery(['127.0.0.3'], [port], 0.3)
+    message = VentaAPI('aa:bb:cc:dd:ee:03', '127.0.0.3', port, hash=1234).get_info_str()
+    assert discovery.resolve('aa:bb:cc:dd:ee:03', message) == ('127.0.0.3', port)
+    header = devices[1].documents[-1]['Header']
+    assert (header['macAdress'], header['Hash']) == ('aa:bb:cc:dd:ee:03', '1234')
+
+
+def test_discovery_follows_moved_device(devices):
+    port = devices[0].address[1]
+    discovery = VentaDiscovery(['127.0.0.2', '127.0.0.3', '127.0.0.4'], [port], 0.3)
+    assert discovery.resolve('aa:bb:cc:dd:ee:02') == ('127.0.0.2', port)
+    devices[0].stop()
+    moved = FakeVenta(host='127.0.0.4', port=port, mac='aa:bb:cc:dd:ee:02').start()
+    try:
+        assert discovery.resolve('aa:bb:cc:dd:ee:02') == ('127.0.0.4', port)
+        assert discovery.lookup('aa:bb:cc:dd:ee:02') == ('127.0.0.4', port)
+    finally:
+        moved.stop()
+    assert discovery.resolve('ff:ff:ff:ff:ff:ff') is None
+
+
+def test_stopped_discovery_does_not_probe(devices):
+    discovery = VentaDiscovery(['127.0.0.2', '127.0.0.3'], [devices[0].address[1]], 0.3)
+    discovery.stop()
+    assert discovery.scan() == {}
+    assert sum(server.requests['GET /Complete'] for server in devices) == 0
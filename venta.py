@@ -0,0 +1,503 @@
+# Venta device protocol, shared by the Domoticz plugin and standalone clients
+import json
+import logging
+import re
+import socket
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class VentaAPI:
+    METHODS = {
+        'get_info': 'GET /Complete',
+        'set_opt': 'POST /Action'
+    }
+
+    class OnOff:
+        def __init__(self, parent_class, method_name, *_):
+            self.method_name = method_name
+            self.parent_class = parent_class
+
+        def on(self, *_):
+            return self.method_name, True
+
+        def off(self, *_):
+            return self.method_name, False
+
+    class ZeroOne:
+        def __init__(self, parent_class, method_name, *args):
+            self.method_name = method_name
+            self.parent_class = parent_class
+            if args:
+                self._set_methods_names(*args[0])
+
+        def _set_methods_names(self, first_name, second_name):
+            setattr(self, first_name, self.zero)
+            setattr(self, second_name, self.one)
+            setattr(self, "off", self.zero)
+            setattr(self, "on", self.one)
+
+        def one(self, *_):
+            return self.method_name, 1
+
+        def zero(self, *_):
+            return self.method_name, 0
+
+    class Levels:
+        def __init__(self, parent_class, method_name, *args):
+            self.method_name = method_name
+            self.parent_class = parent_class
+            self._set_methods_names()
+            if args:
+                self.available_levels = args[0]
+
+        def _set_methods_names(self):
+            setattr(self, "off", self.set_level)
+            setattr(self, "on", self.set_level)
+
+        def set_level(self, domoticz_level, *_):
+            list_idx = int(domoticz_level / 10)
+            if list_idx < len(self.available_levels):
+                return self.method_name, self.available_levels[list_idx]
+            else:
+                return None, None
+
+    TARGET_HUM = [0, 30, 35, 40, 45, 50, 55, 60, 65, 70]
+    TARGET_TIMERS = [0, 1, 3, 5, 7, 9]
+    FAN_SPED = [0, 1, 2, 3, 4, 5]
+
+    command_dict = {
+        'Power': (OnOff, []),
+        'Automatic': (OnOff, []),
+        'Boost': (OnOff, []),
+        'SleepMode': (OnOff, []),
+        'ChildLock': (OnOff, []),
+        'TempUnit': (ZeroOne, ["celsius", "fahrenheit"]),  # 0 - celsius, 1 - fahrenheit
+        'DisplayLeft': (ZeroOne, ["humidity", "temperature"]),  # 0 - humidity, 1 - temperature
+        'DisplayRight': (ZeroOne, ["vlines", "square"]),  # 0 - vertical line, 1 - square
+        'FanSpeed': (Levels, FAN_SPED),
+        'TargetHum': (Levels, TARGET_HUM),
+        'Timer': (Levels, TARGET_TIMERS),
+        'SysLanguage': (Levels, [0, 1, 2, 3, 4, 5, 6, 7, 8]),
+    }
+
+    SysLang = {
+        0: 'English',
+        1: 'Chinese',
+        2: 'English Kuubek XL-T',
+        3: 'Deutsch(selected)/British',
+        4: 'Deutsch(selected)/French',
+        5: 'British(selected)/French',
+        6: 'Chinese(selected)/British',
+        7: 'Russian(Selected)/British',
+        8: ['Polish(Selected)/British', ['CleanLanguage', 0, 6]]
+    }
+
+    # Request layout: method line, indented Content-Length line, empty line, indented JSON body.
+    # Content-Length counts the body without its outer braces.
+    REQUEST_INDENT = ' ' * 24
+    # Encoded '"Name":' prefixes of Action entries, shared by all instances
+    _action_prefixes = {}
+
+    def __init__(self, mac_address, host, port=48000, hash=0, app_name=''):
+        self.header = f'"Header":{{"macAdress":"{mac_address}","DeviceType":2,' \
+                      f'"Hash":"{hash}","DeviceName":"{app_name}"}}'
+        self.mac_address = mac_address
+        self.host = host
+        self.port = int(port)
+        self._header_bytes = self.header.encode()
+        # Poll request never changes, build it once
+        self._get_info_message = self._prep_method('get_info')
+        # Command handlers, created on first use
+        self._handlers = {}
+
+    def __getattr__(self, name):
+        # venta.Power.on() style access to command handlers
+        if name in VentaAPI.command_dict:
+            return self.handler(name)
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+    def handler(self, method_name):
+        handler = self._handlers.get(method_name)
+        if handler is None:
+            handler_class, args = self.command_dict[method_name]
+            handler = self._handlers[method_name] = handler_class(self, method_name, args)
+        return handler
+
+    def send_command(self, message, timeout=1):
+        # Blocking request, returns received data up to the end of the first response document
+        received_data = bytearray()
+        try:
+            with socket.create_connection((self.host, self.port), timeout=timeout) as local_socket:
+                local_socket.sendall(message)
+                decoder = FrameDecoder()
+                while True:
+                    data = local_socket.recv(4096)
+                    if not data:
+                        break
+                    received_data += data
+                    if decoder.feed(data):
+                        break
+        except OSError as e:
+            logger.debug(f"send_command to {self.host}:{self.port} failed: {str(e)}")
+        return received_data.decode("utf-8", errors="replace")
+
+    @staticmethod
+    def _format_value(value):
+        if isinstance(value, bool):
+            return b'true' if value else b'false'
+        return str(value).encode()
+
+    @classmethod
+    def _action_prefix(cls, name):
+        prefix = cls._action_prefixes.get(name)
+        if prefix is None:
+            prefix = cls._action_prefixes[name] = f'"{name}":'.encode()
+        return prefix
+
+    def _prep_method(self, method, actions=None):
+        command_line = self._header_bytes
+        if method == 'set_opt':
+            command_line = b'"Action":{' + b','.join(self._action_prefix(name) + self._format_value(value)
+                                                     for name, value in actions.items()) + b'},' + command_line
+
+        return b'%s\n%sContent-Length: %d\n\n%s{%s}' % (self.METHODS[method].encode(), self.REQUEST_INDENT.encode(),
+                                                       len(command_line), self.REQUEST_INDENT.encode(), command_line)
+
+    def get_info(self):
+        return self.send_command(self._prep_method('get_info'))
+
+    def get_info_str(self):
+        return self._get_info_message
+
+    def set_param(self, command_name, value):
+        return self._prep_method('set_opt', {command_name: value})
+
+    def set_params(self, actions: dict):
+        return self._prep_method('set_opt', actions)
+
+
+class FrameDecoder:
+    """Splits a TCP stream into JSON documents.
+
+    Data may arrive split or coalesced, so it is buffered until a whole document is available.
+    When a response carries a Content-Length header and that many bytes arrived at once, the document
+    is parsed straight from the buffer. Otherwise, or when the header is wrong, the end of a document
+    is found by counting braces, so a header overstating the body does not stall decoding. Scanning
+    state is kept between calls so every byte is scanned only once. Buffer is limited to
+    max_buffer_size, data which does not fit or does not look like a document is discarded.
+    """
+    CONTENT_LENGTH = re.compile(rb'content-length:\s*(\d+)', re.IGNORECASE)
+    SPECIAL_CHARS = re.compile(rb'[{}"\\]')
+    MAX_BUFFER_SIZE = 64 * 1024
+    MAX_HEADER_SIZE = 1024
+    JSON_DECODER = json.JSONDecoder()
+
+    def __init__(self, max_buffer_size=MAX_BUFFER_SIZE):
+        self.max_buffer_size = max_buffer_size
+        self.buffer = bytearray()
+        self.discarded = 0
+        self._reset_scan()
+
+    def _reset_scan(self):
+        self._start = -1
+        self._expected_end = -1
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+
+    def _discard(self, size, reason):
+        logger.debug(f"FrameDecoder: discarding {size} bytes, {reason}")
+        del self.buffer[:size]
+        self.discarded += 1
+        self._reset_scan()
+
+    def reset(self):
+        self.buffer.clear()
+        self._reset_scan()
+
+    def feed(self, data: bytes) -> list:
+        self.buffer += data
+        documents = []
+        while self.buffer:
+            document, end = self._find_document()
+            if end < 0:
+                if len(self.buffer) > self.max_buffer_size:
+                    self._discard(len(self.buffer), "buffer size limit exceeded")
+                break
+
+            raw_document = bytes(self.buffer[self._start:end])
+            del self.buffer[:end]
+            self._reset_scan()
+            if document is None:
+                try:
+                    document = json.loads(raw_document.decode())
+                except ValueError as e:
+                    logger.debug(f"FrameDecoder: invalid document {str(e)}")
+                    self.discarded += 1
+                    continue
+            if isinstance(document, dict):
+                documents.append(document)
+        return documents
+
+    def _find_document(self):
+        # Returns document, if it was already parsed, and position of its end in the buffer
+        if self._start < 0:
+            self._start = self.buffer.find(b'{')
+            if self._start < 0:
+                # Only a header may precede a document, anything longer is garbage
+                if len(self.buffer) > self.MAX_HEADER_SIZE:
+                    self._discard(len(self.buffer), "no JSON document found")
+                return None, -1
+            content_length = self.CONTENT_LENGTH.search(self.buffer, 0, self._start)
+            if content_length:
+                self._expected_end = self._start + int(content_length.group(1))
+            self._pos = self._start
+
+        if len(self.buffer) < self._expected_end:
+            # Header may overstate the body, take a complete document without waiting for the rest
+            return None, self._scan_document_end()
+
+        if self._expected_end >= 0 and self._pos == self._start:
+            # Announced body is complete, let json find where the document ends
+            text = self.buffer[self._start:].decode(errors='surrogateescape')
+            try:
+                document, end = self.JSON_DECODER.raw_decode(text)
+            except ValueError:
+                pass
+            else:
+                if not text.isascii():
+                    end = len(text[:end].encode(errors='surrogateescape'))
+                return document, self._start + end
+
+        return None, self._scan_document_end()
+
+    def _scan_document_end(self) -> int:
+        while True:
+            match = self.SPECIAL_CHARS.search(self.buffer, self._pos)
+            if match is None:
+                self._pos = max(self._pos, len(self.buffer))
+                return -1
+            char = match.group()
+            self._pos = match.end()
+            if self._in_string:
+                if char == b'\\':
+                    # Skip escaped character
+                    self._pos += 1
+                elif char == b'"':
+                    self._in_string = False
+            elif char == b'"':
+                self._in_string = True
+            elif char == b'{':
+                self._depth += 1
+            elif char == b'}':
+                self._depth -= 1
+                if self._depth == 0:
+                    return self._pos
+
+
+def expand_hosts(spec):
+    """Comma separated hosts and subnets (192.168.1.0/24) to the list of host addresses."""
+    # Discovery is optional, do not load its modules at plugin start
+    import ipaddress
+    hosts = []
+    for entry in (part.strip() for part in spec.split(',')):
+        if not entry:
+            continue
+        if '/' in entry:
+            network = ipaddress.ip_network(entry, strict=False)
+            hosts.extend(str(host) for host in (network.hosts() if network.num_addresses > 1 else network))
+        else:
+            hosts.append(entry)
+    return hosts
+
+
+class VentaDiscovery:
+    """Finds Venta devices in the LAN by their MAC address.
+
+    Hosts and ports are probed in parallel with GET /Complete, at most concurrency at a time and each
+    within timeout seconds. MAC addresses reported by the devices are cached per "host:port", so a
+    moved device is looked for at known addresses first, the cache can be stored in a JSON file.
+    Probes send message, a get_info request, devices should be probed with their own one. stop()
+    ends a running scan, probes already started finish within timeout.
+    """
+    def __init__(self, hosts, ports=(48000,), timeout=0.5, concurrency=64, cache_path=None, message=None):
+        self.hosts = list(hosts)
+        self.ports = [int(port) for port in ports]
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.cache_path = cache_path
+        # "host:port" to lower case MAC address
+        self.cache = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.message = message if message is not None else VentaAPI('', '').get_info_str()
+        if cache_path is not None:
+            self.load()
+
+    @staticmethod
+    def _key(host, port):
+        return f"{host}:{port}"
+
+    def lookup(self, mac):
+        """Cached (host, port) of the device, None when it was never found."""
+        mac = mac.lower()
+        with self.lock:
+            for key, cached_mac in self.cache.items():
+                if cached_mac == mac:
+                    host, port = key.rsplit(':', 1)
+                    return host, int(port)
+        return None
+
+    def stop(self):
+        self.stopped.set()
+
+    def probe(self, host, port, message=None):
+        """MAC address reported by a device at host:port, None when nothing answers in time."""
+        if self.stopped.is_set():
+            return None
+        deadline = time.monotonic() + self.timeout
+        try:
+            with socket.create_connection((host, port), timeout=self.timeout) as probe_socket:
+                probe_socket.sendall(message if message is not None else self.message)
+                decoder = FrameDecoder()
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or self.stopped.is_set():
+                        return None
+                    probe_socket.settimeout(remaining)
+                    data = probe_socket.recv(4096)
+                    if not data:
+                        return None
+                    for document in decoder.feed(data):
+                        mac = document.get('Header', {}).get('MacAdress')
+                        return mac.lower() if isinstance(mac, str) else None
+        except OSError:
+            return None
+
+    def scan(self, macs=None, message=None):
+        """Probes all hosts and ports, returns found MAC address to (host, port).
+
+        When macs are given, scanning stops as soon as all of them are found or stop() is called.
+        """
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        wanted = {mac.lower() for mac in macs} if macs else None
+        known = set()
+        for mac in wanted or ():
+            address = self.lookup(mac)
+            if address is not None:
+                known.add(address)
+        # Known addresses first, a device is most likely still there or was just restarted
+        targets = sorted(((host, port) for host in self.hosts for port in self.ports),
+                         key=lambda address: address not in known)
+        found = {}
+        started = time.monotonic()
+        executor = ThreadPoolExecutor(max_workers=max(1, min(self.concurrency, len(targets))))
+        futures = {}
+        try:
+            futures = {executor.submit(self.probe, host, port, message): (host, port) for host, port in targets}
+            for future in as_completed(futures):
+                if self.stopped.is_set():
+                    break
+                mac = future.result()
+                if mac is None:
+                    continue
+                host, port = futures[future]
+                found[mac] = (host, port)
+                with self.lock:
+                    # Only one address per device, drop the one it had before
+                    for key in [key for key, cached_mac in self.cache.items() if cached_mac == mac]:
+                        del self.cache[key]
+                    self.cache[self._key(host, port)] = mac
+                if wanted is not None and wanted <= found.keys():
+                    break
+        finally:
+            for future in futures:
+                future.cancel()
+            # Started probes end within timeout, no thread outlives the scan
+            executor.shutdown(wait=True)
+        logger.debug(f"Scanned {len(targets)} addresses in {time.monotonic() - started:.2f} s, "
+                     f"found {len(found)} devices")
+        if found and self.cache_path is not None:
+            self.save()
+        return found
+
+    def resolve(self, mac, message=None):
+        """Current (host, port) of the device with the given MAC address, None when not found."""
+        return self.scan([mac], message).get(mac.lower())
+
+    def load(self):
+        try:
+            with open(self.cache_path) as cache_file:
+                cache = json.load(cache_file)
+        except (OSError, ValueError) as e:
+            logger.debug(f"Cannot load discovery cache {self.cache_path}: {str(e)}")
+            return
+        with self.lock:
+            self.cache.update({key: str(mac).lower() for key, mac in cache.items()})
+
+    def save(self):
+        with self.lock:
+            cache = dict(self.cache)
+        try:
+            with open(self.cache_path, 'w') as cache_file:
+                json.dump(cache, cache_file)
+        except OSError as e:
+            logger.error(f"Cannot save discovery cache {self.cache_path}: {str(e)}")
+
+
+class CaptureWriter:
+    """Appends raw data sent to and received from devices to a capture file.
+
+    File starts with MAGIC, followed by records: RECORD header (timestamp, direction, length of the
+    connection name, length of data), connection name and data.
+    """
+    MAGIC = b'VENTACAP1\n'
+    RECORD = struct.Struct('<dBHI')
+    SENT = 0
+    RECEIVED = 1
+
+    def __init__(self, path):
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(self.MAGIC)
+
+    def write(self, direction, connection_name, data, timestamp=None):
+        name = connection_name.encode()
+        self.file.write(self.RECORD.pack(time.time() if timestamp is None else timestamp, direction, len(name),
+                                         len(data)) + name + bytes(data))
+        # Capture is most useful after a crash, do not keep records in the buffer
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_capture(path):
+    """Iterator of (timestamp, direction, connection name, data) records of a capture file.
+
+    File is opened and checked at once, so OSError or ValueError is raised here, not on the first record.
+    """
+    capture_file = open(path, 'rb')
+    if capture_file.read(len(CaptureWriter.MAGIC)) != CaptureWriter.MAGIC:
+        capture_file.close()
+        raise ValueError(f"{path} is not a Venta capture file")
+    return _read_records(capture_file)
+
+
+def _read_records(capture_file):
+    with capture_file:
+        while True:
+            header = capture_file.read(CaptureWriter.RECORD.size)
+            if len(header) < CaptureWriter.RECORD.size:
+                return
+            timestamp, direction, name_length, data_length = CaptureWriter.RECORD.unpack(header)
+            name = capture_file.read(name_length).decode()
+            data = capture_file.read(data_length)
+            if len(data) < data_length:
+                # Record cut short by a crash
+                return
+            yield timestamp, direction, name, data
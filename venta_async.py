@@ -0,0 +1,169 @@
+# Asyncio client for Venta devices, meant for scripts running outside Domoticz
+"""
+Polls many Venta devices concurrently from one process.
+
+    pool = ConnectionPool()
+    client = AsyncVentaClient('192.168.1.10', mac_address='..', hash='..', pool=pool)
+    state = await client.get_info()
+    await client.set_param('FanSpeed', 2)
+
+Command line: python venta_async.py --hash HASH 192.168.1.10 192.168.1.11
+"""
+import argparse
+import asyncio
+import json
+import logging
+
+from venta import VentaAPI, FrameDecoder
+
+logger = logging.getLogger(__name__)
+
+
+class PooledConnection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        # Decoder lives with the connection, so data left after a response is not lost
+        self.decoder = FrameDecoder()
+
+    def usable(self):
+        return not self.reader.at_eof() and not self.writer.is_closing()
+
+    def close(self):
+        self.writer.close()
+
+
+class ConnectionPool:
+    """Keeps idle connections per (host, port) and limits concurrent connections to one device."""
+    def __init__(self, max_connections_per_host=1):
+        self.max_connections_per_host = max_connections_per_host
+        self._idle = {}
+        self._limits = {}
+
+    def _limit(self, address):
+        if address not in self._limits:
+            self._limits[address] = asyncio.Semaphore(self.max_connections_per_host)
+        return self._limits[address]
+
+    async def acquire(self, host, port, timeout):
+        address = (host, port)
+        await self._limit(address).acquire()
+        try:
+            idle = self._idle.get(address, [])
+            while idle:
+                connection = idle.pop()
+                if connection.usable():
+                    return connection
+                connection.close()
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+            return PooledConnection(reader, writer)
+        except BaseException:
+            self._limit(address).release()
+            raise
+
+    def release(self, host, port, connection, reuse=True):
+        address = (host, port)
+        if reuse and connection.usable():
+            self._idle.setdefault(address, []).append(connection)
+        else:
+            connection.close()
+        self._limit(address).release()
+
+    def close(self):
+        for idle in self._idle.values():
+            for connection in idle:
+                connection.close()
+        self._idle.clear()
+
+
+class AsyncVentaClient:
+    def __init__(self, host, port=48000, mac_address='', hash=0, app_name='', pool=None,
+                 timeout=2.0, retries=2, retry_delay=0.2):
+        self.api = VentaAPI(mac_address, host, port, hash=hash, app_name=app_name)
+        self.pool = pool if pool is not None else ConnectionPool()
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+    async def _read_document(self, connection):
+        while True:
+            data = await connection.reader.read(4096)
+            if not data:
+                raise ConnectionError(f"{self.api.host} closed connection")
+            documents = connection.decoder.feed(data)
+            if documents:
+                return documents[-1]
+
+    async def _exchange(self, message):
+        connection = await self.pool.acquire(self.api.host, self.api.port, self.timeout)
+        reuse = False
+        try:
+            connection.writer.write(message)
+            await connection.writer.drain()
+            document = await asyncio.wait_for(self._read_document(connection), self.timeout)
+            reuse = True
+            return document
+        finally:
+            self.pool.release(self.api.host, self.api.port, connection, reuse)
+
+    async def request(self, message) -> dict:
+        for attempt in range(self.retries + 1):
+            try:
+                return await self._exchange(message)
+            except (OSError, asyncio.TimeoutError) as e:
+                if attempt == self.retries:
+                    raise
+                logger.debug(f"{self.api.host}: request failed ({e!r}), retry {attempt + 1}/{self.retries}")
+                await asyncio.sleep(self.retry_delay * 2 ** attempt)
+
+    async def get_info(self) -> dict:
+        return await self.request(self.api.get_info_str())
+
+    async def set_param(self, command_name, value) -> dict:
+        return await self.request(self.api.set_param(command_name, value))
+
+    async def set_params(self, actions: dict) -> dict:
+        return await self.request(self.api.set_params(actions))
+
+
+async def poll_all(clients, concurrency=100) -> list:
+    """Returns get_info result, or the exception raised, of every client."""
+    limit = asyncio.Semaphore(concurrency)
+
+    async def poll(client):
+        async with limit:
+            return await client.get_info()
+
+    return await asyncio.gather(*(poll(client) for client in clients), return_exceptions=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Read state of Venta devices")
+    parser.add_argument('hosts', nargs='+')
+    parser.add_argument('--port', type=int, default=48000)
+    parser.add_argument('--mac', default='ff:ff:ff:ff:ff:ff')
+    parser.add_argument('--hash', default='0')
+    parser.add_argument('--app-name', default='Venta App')
+    parser.add_argument('--timeout', type=float, default=2.0)
+    parser.add_argument('--retries', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=100)
+    args = parser.parse_args()
+
+    async def run():
+        pool = ConnectionPool()
+        clients = [AsyncVentaClient(host, args.port, args.mac, args.hash, args.app_name, pool,
+                                    args.timeout, args.retries) for host in args.hosts]
+        try:
+            return await poll_all(clients, args.concurrency)
+        finally:
+            pool.close()
+
+    for host, result in zip(args.hosts, asyncio.run(run())):
+        if isinstance(result, BaseException):
+            print(f"{host}: error {result!r}")
+        else:
+            print(f"{host}: {json.dumps(result)}")
+
+
+if __name__ == '__main__':
+    main()